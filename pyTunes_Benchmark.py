@@ -0,0 +1,376 @@
+import os, sys, argparse, json, random, shutil, subprocess, tempfile, time, tracemalloc, platform
+from statistics import median
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+from pyTunes_Export import iTunes_Library, Export_Manifest, determine_writers, export_writers
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+##################################################################
+## CONSTANTS
+##################################################################
+
+BACKENDS = sorted(iTunes_Library.PARSERS) # backends benchmarked by default
+FORMATS = ["wpl", "m3u8"] # formats written by default
+PHASES = ["parse", "select", "resolve", "write"] # phases timed for every backend
+TABLE_WIDTH = 50 # width of table used to print results
+
+DEFAULT_TRACKS = 10000 # default number of tracks in a generated library
+DEFAULT_PLAYLISTS = 100 # default number of playlists in a generated library
+DEFAULT_ITEMS = 100 # default average number of items in a generated playlist
+FOLDER_RATIO = 0.1 # share of generated playlists that are folders
+SMART_RATIO = 0.2 # share of generated playlists that are smart playlists
+FIRST_TRACK_ID = 100 # Track ID of the first generated track
+
+# words used to build names, including ones that need escaping in XML and URLs
+WORDS = ["Love", "Night", "Blue", "Café", "Straße", "東京", "Ñandú", "Rock & Roll",
+         "<Live>", "100%", "\"Quoted\"", "Don't", "Déjà Vu", "Ελλάδα", "Москва",
+         "🎵", "Tab\tSeparated", "C#", "A+B", "Mix #1"]
+KINDS = ["MPEG audio file", "AAC audio file", "Apple Lossless audio file"]
+
+PLIST_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+                '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                '<plist version="1.0">\n<dict>\n'
+                '\t<key>Major Version</key><integer>1</integer>\n'
+                '\t<key>Minor Version</key><integer>1</integer>\n'
+                '\t<key>Date</key><date>2015-11-09T12:00:00Z</date>\n'
+                '\t<key>Application Version</key><string>12.3.1.23</string>\n'
+                '\t<key>Show Content Ratings</key><true/>\n'
+                '\t<key>Music Folder</key><string>file://localhost/C:/Music/</string>\n'
+                '\t<key>Library Persistent ID</key><string>0123456789ABCDEF</string>\n')
+
+##################################################################
+## FUNCTIONS
+##################################################################
+
+def get_words(generator, count):
+    """Returns a name made of the given number of random words"""
+    return " ".join(generator.choice(WORDS) for index in range(count))
+
+def get_persistent_ID(generator):
+    """Returns a random persistent ID"""
+    return "%016X" % generator.getrandbits(64)
+
+def write_track(file, generator, track_id):
+    """Writes the <dict> of a generated track"""
+
+    artist = get_words(generator, generator.randint(1, 2))
+    album = get_words(generator, generator.randint(1, 3))
+    name = get_words(generator, generator.randint(1, 4))
+    number = generator.randint(1, 20)
+    location = ("file://localhost/C:/Music/" + quote(artist) + "/" + quote(album) + "/" +
+                quote("%02d %s.m4a" % (number, name)))
+
+    file.write('\t\t<key>%d</key>\n\t\t<dict>\n' % track_id +
+               '\t\t\t<key>Track ID</key><integer>%d</integer>\n' % track_id +
+               '\t\t\t<key>Name</key><string>%s</string>\n' % escape(name) +
+               '\t\t\t<key>Artist</key><string>%s</string>\n' % escape(artist) +
+               '\t\t\t<key>Album</key><string>%s</string>\n' % escape(album) +
+               '\t\t\t<key>Kind</key><string>%s</string>\n' % generator.choice(KINDS) +
+               '\t\t\t<key>Size</key><integer>%d</integer>\n' % generator.randint(10 ** 6, 10 ** 7) +
+               '\t\t\t<key>Total Time</key><integer>%d</integer>\n' % generator.randint(30000, 600000) +
+               '\t\t\t<key>Track Number</key><integer>%d</integer>\n' % number +
+               '\t\t\t<key>Year</key><integer>%d</integer>\n' % generator.randint(1950, 2015) +
+               '\t\t\t<key>Date Modified</key><date>2015-01-01T12:00:00Z</date>\n' +
+               '\t\t\t<key>Date Added</key><date>2015-01-02T12:00:00Z</date>\n' +
+               '\t\t\t<key>Bit Rate</key><integer>256</integer>\n' +
+               '\t\t\t<key>Sample Rate</key><integer>44100</integer>\n' +
+               '\t\t\t<key>Play Count</key><integer>%d</integer>\n' % generator.randint(0, 100) +
+               '\t\t\t<key>Persistent ID</key><string>%s</string>\n' % get_persistent_ID(generator) +
+               '\t\t\t<key>Track Type</key><string>File</string>\n' +
+               '\t\t\t<key>Location</key><string>%s</string>\n' % escape(location) +
+               '\t\t\t<key>File Folder Count</key><integer>-1</integer>\n' +
+               '\t\t\t<key>Library Folder Count</key><integer>-1</integer>\n' +
+               '\t\t</dict>\n')
+
+def write_playlist(file, generator, name, persistent_ID, parent_ID = None, folder = False,
+                   smart = False, track_ids = ()):
+    """Writes the <dict> of a generated playlist"""
+
+    file.write('\t\t<dict>\n\t\t\t<key>Name</key><string>%s</string>\n' % escape(name) +
+               '\t\t\t<key>Playlist ID</key><integer>%d</integer>\n' % generator.randint(1, 10 ** 6) +
+               '\t\t\t<key>Playlist Persistent ID</key><string>%s</string>\n' % persistent_ID)
+    if parent_ID is not None:
+        file.write('\t\t\t<key>Parent Persistent ID</key><string>%s</string>\n' % parent_ID)
+    if folder:
+        file.write('\t\t\t<key>Folder</key><true/>\n')
+    if smart:
+        file.write('\t\t\t<key>Smart Info</key>\n\t\t\t<data>\n\t\t\tAQEAAwAAAAIAAAAZAAAAAAAAAAcAAAABAAAAAAAAAAAAAAAA\n\t\t\t</data>\n' +
+                   '\t\t\t<key>Smart Criteria</key>\n\t\t\t<data>\n\t\t\tU0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\n\t\t\t</data>\n')
+    file.write('\t\t\t<key>All Items</key><true/>\n')
+    if track_ids:
+        file.write('\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n')
+        file.write("".join('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key><integer>%d</integer>\n'
+                           '\t\t\t\t</dict>\n' % track_id for track_id in track_ids))
+        file.write('\t\t\t</array>\n')
+    file.write('\t\t</dict>\n')
+
+def generate_library(location, tracks = DEFAULT_TRACKS, playlists = DEFAULT_PLAYLISTS,
+                     items = DEFAULT_ITEMS, seed = 0):
+    """Writes a realistic iTunes library xml file with the given number of tracks and playlists
+
+    Besides the master Library playlist, some of the playlists are folders
+    nested inside each other and some are smart playlists. Names and paths mix
+    in characters that need escaping in XML and percent-encoding in URLs.
+    """
+
+    generator = random.Random(seed)
+    file = open(location, 'w', encoding = "utf-8")
+    file.write(PLIST_HEADER)
+
+    # TRACKS
+    track_ids = []
+    track_id = FIRST_TRACK_ID
+    file.write('\t<key>Tracks</key>\n\t<dict>\n')
+    for index in range(tracks):
+        write_track(file, generator, track_id)
+        track_ids.append(track_id)
+        track_id += generator.randint(1, 3)
+    file.write('\t</dict>\n')
+
+    # PLAYLISTS
+    file.write('\t<key>Playlists</key>\n\t<array>\n')
+    write_playlist(file, generator, "Library", get_persistent_ID(generator), track_ids = track_ids)
+    folders = [None]
+    for index in range(playlists):
+        persistent_ID = get_persistent_ID(generator)
+        parent_ID = generator.choice(folders)
+        name = get_words(generator, generator.randint(1, 3)) + " " + str(index)
+
+        # folders can contain playlists and other folders
+        if generator.random() < FOLDER_RATIO:
+            write_playlist(file, generator, name, persistent_ID, parent_ID, folder = True)
+            folders.append(persistent_ID)
+            continue
+
+        length = min(int(generator.expovariate(1.0 / max(items, 1))), len(track_ids))
+        write_playlist(file, generator, name, persistent_ID, parent_ID,
+                       smart = generator.random() < SMART_RATIO,
+                       track_ids = [generator.choice(track_ids) for item in range(length)])
+    file.write('\t</array>\n</dict>\n</plist>\n')
+    file.close()
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process in KB, or None if unknown"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports the peak in bytes rather than KB
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def measure_memory(xml_file, backend):
+    """Reads a library and resolves all of its playlists, measuring the memory used
+
+    Returns the peak and retained number of bytes allocated and the number of
+    tracks resolved.
+    """
+
+    tracemalloc.start()
+    library = iTunes_Library(xml_file, backend)
+    library.get_items([], True)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak, retained, len(library.parser.track_index.tracks)
+
+def run_phases(xml_file, backend, formats, selected = 0, seed = 0):
+    """Times each phase of exporting a library with a backend, returning the results
+
+    If selected is not 0, only that many playlists picked at random are
+    exported, otherwise every playlist is.
+    """
+
+    results = {'backend' : backend, 'phases' : {}, 'peak_rss_kb' : {}}
+    timer = time.perf_counter()
+
+    def finish(phase):
+        """Records the time taken by a phase and the peak RSS after it"""
+        results['phases'][phase] = time.perf_counter() - timer
+        results['peak_rss_kb'][phase] = get_peak_rss()
+        return time.perf_counter()
+
+    library = iTunes_Library(xml_file, backend)
+    library.get_playlists()
+    timer = finish("parse")
+
+    names = []
+    if selected:
+        names = [playlist.name for playlist in
+                 random.Random(seed).sample(library.playlists, min(selected, len(library.playlists)))]
+    export = library.get_selection(names, not selected)
+    timer = finish("select")
+
+    for playlist in export:
+        playlist.set_items()
+    timer = finish("resolve")
+
+    export_location = tempfile.mkdtemp(prefix = "pyTunes_Benchmark")
+    try:
+        writers = determine_writers(export, Namespace(extension = formats, folder_tree = False),
+                                    export_location)
+        manifest = Export_Manifest(export_location)
+        export_writers(manifest, writers)
+        manifest.save()
+        timer = finish("write")
+    finally:
+        shutil.rmtree(export_location)
+
+    results['playlists'] = len(export)
+    results['tracks'] = len(library.parser.track_index.tracks)
+    results['files'] = manifest.written
+    return results
+
+def benchmark(xml_file, backend, formats, selected = 0, seed = 0, memory = False):
+    """Runs the benchmarks of a backend with the output of the library code suppressed"""
+
+    with redirect_stdout(open(os.devnull, 'w')):
+        results = run_phases(xml_file, backend, formats, selected, seed)
+        if memory:
+            peak, retained, tracks = measure_memory(xml_file, backend)
+            tracks = max(tracks, 1)
+            results['bytes_per_track'] = {'peak' : peak // tracks, 'retained' : retained // tracks}
+    return results
+
+def measure_startup(xml_file, runs):
+    """Returns the median number of seconds a fresh interpreter takes to import pyTunes Export
+    and to run the command line up to the end of parsing the library"""
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyTunes_Export.py")
+    export_location = tempfile.mkdtemp()
+    commands = {'import' : [sys.executable, "-c", "import pyTunes_Export"],
+                'parse' : [sys.executable, script, "--headless", "--no-cache", "-a",
+                           "--library", xml_file, "--export-dir", export_location,
+                           "--stats-json", os.path.join(export_location, "stats.json")]}
+    startup = {}
+    try:
+        for name, command in sorted(commands.items()):
+            times = []
+            for run in range(runs):
+                start = time.perf_counter()
+                subprocess.run(command, stdout = subprocess.DEVNULL, check = True,
+                               cwd = os.path.dirname(script))
+                times.append(time.perf_counter() - start)
+                if name == 'parse':
+                    # only count the time up to the end of the parse phase
+                    stats_file = open(os.path.join(export_location, "stats.json"))
+                    phases = json.load(stats_file)['phases']
+                    stats_file.close()
+                    after = False
+                    for phase in phases:
+                        if after:
+                            times[-1] -= phase['seconds']
+                        after = after or phase['name'] == "parse"
+            startup[name] = median(times)
+    finally:
+        shutil.rmtree(export_location)
+    return startup
+
+def print_results(results):
+    """Prints the time taken by each phase and the memory used by a backend"""
+
+    print(results['backend'] + " (" + str(results['tracks']) + " tracks, " +
+          str(results['playlists']) + " playlists, " + str(results['files']) + " files)")
+    for phase in PHASES:
+        start = " " * 4 + phase
+        end = "%.3f s" % results['phases'][phase]
+        if results['peak_rss_kb'][phase] is not None:
+            end += ", " + str(results['peak_rss_kb'][phase] // 1024) + " MB peak RSS"
+        print(start + " " * max(TABLE_WIDTH - len(start) - len(end), 1) + end)
+    if 'bytes_per_track' in results:
+        start = " " * 4 + "memory"
+        end = (str(results['bytes_per_track']['peak']) + " B/track peak, " +
+               str(results['bytes_per_track']['retained']) + " B/track retained")
+        print(start + " " * max(TABLE_WIDTH - len(start) - len(end), 1) + end)
+
+def command_line_args():
+    """Set up command line arguments"""
+
+    parser = argparse.ArgumentParser(description = "Benchmark pyTunes Export")
+    parser.add_argument('library', nargs = '?',
+                        help = "iTunes library xml file to benchmark with, one is generated " +
+                        "if it is not given")
+    parser.add_argument('-b', '--backend', nargs = '*', choices = BACKENDS, default = BACKENDS,
+                        help = "specify the parsers to benchmark")
+    parser.add_argument('-e', '--extension', nargs = '*', default = FORMATS,
+                        help = "specify the formats to write")
+    parser.add_argument('-p', '--playlists', type = int, default = 0,
+                        help = "export only this many playlists picked at random")
+    parser.add_argument('-m', '--memory', action = 'store_true',
+                        help = "also measure the memory allocated per track with tracemalloc")
+    parser.add_argument('-o', '--output', help = "save the results to this JSON file")
+    parser.add_argument('--tracks', type = int, default = DEFAULT_TRACKS,
+                        help = "number of tracks in the generated library")
+    parser.add_argument('--generate-playlists', type = int, default = DEFAULT_PLAYLISTS,
+                        help = "number of playlists in the generated library")
+    parser.add_argument('--items', type = int, default = DEFAULT_ITEMS,
+                        help = "average number of items in a generated playlist")
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = "seed used to generate the library and pick playlists")
+    parser.add_argument('--keep', help = "save the generated library to this file")
+    parser.add_argument('--startup', type = int, default = 0, metavar = 'RUNS',
+                        help = "also time starting a fresh process this many times")
+    return parser.parse_args()
+
+##################################################################
+## BODY
+##################################################################
+
+if __name__ == "__main__":
+    args = command_line_args()
+
+    # generate a library if none is given
+    library_location = args.library
+    generated = None
+    if library_location is None:
+        library_location = args.keep
+        if library_location is None:
+            handle, library_location = tempfile.mkstemp(suffix = ".xml")
+            os.close(handle)
+            generated = library_location
+        print("Generating a library with " + str(args.tracks) + " tracks and " +
+              str(args.generate_playlists) + " playlists ...", end = " ")
+        sys.stdout.flush()
+        generate_library(library_location, args.tracks, args.generate_playlists, args.items,
+                         args.seed)
+        print("Done!")
+
+    # run each backend in a process of its own so their peak RSS are separate
+    report = {'library' : {'location' : args.library, 'size' : os.path.getsize(library_location)},
+              'python' : platform.python_version(), 'platform' : platform.platform(),
+              'results' : []}
+    if args.library is None:
+        report['library'].update({'tracks' : args.tracks, 'playlists' : args.generate_playlists,
+                                  'items' : args.items, 'seed' : args.seed})
+    try:
+        if args.startup > 0:
+            report['startup'] = measure_startup(library_location, args.startup)
+            for name in sorted(report['startup']):
+                start = "startup to " + name
+                end = "%.3f s" % report['startup'][name]
+                print(start + " " * max(TABLE_WIDTH - len(start) - len(end), 1) + end)
+        for backend in args.backend:
+            executor = ProcessPoolExecutor(max_workers = 1)
+            results = executor.submit(benchmark, library_location, backend, args.extension,
+                                      args.playlists, args.seed, args.memory).result()
+            executor.shutdown()
+            print_results(results)
+            report['results'].append(results)
+    finally:
+        if generated is not None:
+            os.remove(generated)
+
+    if args.output is not None:
+        output = open(args.output, 'w')
+        json.dump(report, output, indent = 4, sort_keys = True)
+        output.close()
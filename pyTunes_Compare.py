@@ -0,0 +1,471 @@
+import os, sys, argparse, random, shutil, tempfile, time, traceback
+from contextlib import redirect_stdout, redirect_stderr
+from re import sub
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+import pyTunes_Export
+from pyTunes_Export import iTunes_Library, WRITERS, get_writers, export
+from pyTunes_Benchmark import (KINDS, PLIST_HEADER, FIRST_TRACK_ID, get_words,
+                               get_persistent_ID, generate_library)
+
+##################################################################
+## CONSTANTS
+##################################################################
+
+REFERENCE_BACKEND = "minidom" # backend whose output every other backend must match
+BACKENDS = sorted(iTunes_Library.PARSERS) # backends compared by default
+FORMATS = ["wpl", "m3u8"] # formats compared by default
+DEFAULT_LIBRARIES = 20 # default number of fuzzed libraries
+DEFAULT_TRACKS = 300 # default number of tracks in a fuzzed library
+DEFAULT_PLAYLISTS = 30 # default number of playlists in a fuzzed library
+DEFAULT_ITEMS = 40 # default average number of items in a fuzzed playlist
+DEFAULT_GENERATED_TRACKS = 5000 # default number of tracks in the generated library
+DEFAULT_SPILL_SIZE = 1024 # bytes of a playlist kept in memory before it is streamed to disk
+DEFAULT_BUFFER_SIZE = 64 # characters rendered before they are encoded while comparing
+MAX_DIFFERENCES = 5 # differences printed for each backend of each library
+TABLE_WIDTH = 50 # width of table used to print results
+
+# ways the location of a fuzzed track starts
+LOCATION_PREFIXES = ["file://localhost/C:/Music/", "file:///C:/Music/",
+                     "file://localhost/Users/kar/Music/iTunes/iTunes%20Media/Music/",
+                     "file://server/share/Music/", "file://localhost/D:/My%20Music/"]
+
+# character references mixed into fuzzed names
+CHARACTER_REFERENCES = ["&#38;", "&#60;", "&#233;", "&#x1F3B5;", "&#x4E2D;", "&#34;"]
+
+##################################################################
+## FUNCTIONS
+##################################################################
+
+def get_fuzzed_text(generator, words):
+    """Returns a name made of random words, sometimes with character references in it"""
+
+    text = escape(get_words(generator, words))
+    if generator.random() < 0.1:
+        position = generator.randint(0, len(text))
+        while "&" in text[max(position - 6, 0):position]:
+            position = generator.randint(0, len(text))
+        text = text[:position] + generator.choice(CHARACTER_REFERENCES) + text[position:]
+    return text
+
+def get_fuzzed_location(generator, name):
+    """Returns the file:// URL of a fuzzed track, percent-encoded in one of several ways"""
+
+    path = (quote(get_words(generator, generator.randint(1, 2))) + "/" +
+            quote(get_words(generator, generator.randint(1, 2))) + "/" +
+            quote("%02d %s.m4a" % (generator.randint(1, 20), name)))
+    if generator.random() < 0.2:
+        path = sub(r"%[0-9A-F]{2}", lambda match: match.group(0).lower(), path)
+    return escape(generator.choice(LOCATION_PREFIXES) + path)
+
+def write_fuzzed_track(lines, generator, track_id):
+    """Adds the lines of a track <dict> with fields missing, reordered or unusual"""
+
+    name = get_words(generator, generator.randint(1, 4))
+    fields = [('Track ID', '<integer>%d</integer>' % track_id)]
+    if generator.random() < 0.95:
+        if generator.random() < 0.03:
+            fields.append(('Name', '<string></string>'))
+        else:
+            fields.append(('Name', '<string>%s</string>' %
+                           get_fuzzed_text(generator, generator.randint(1, 4))))
+    if generator.random() < 0.95:
+        fields.append(('Artist', '<string>%s</string>' %
+                       get_fuzzed_text(generator, generator.randint(1, 2))))
+    fields.append(('Album', '<string>%s</string>' % escape(get_words(generator, 2))))
+    fields.append(('Kind', '<string>%s</string>' % generator.choice(KINDS)))
+    if generator.random() < 0.95:
+        fields.append(('Total Time', '<integer>%d</integer>' %
+                       generator.choice([0, 1, generator.randint(1000, 10 ** 7)])))
+    fields.append(('Year', '<integer>%d</integer>' % generator.randint(1950, 2015)))
+    fields.append(('Date Added', '<date>2015-01-02T12:00:00Z</date>'))
+    fields.append(('Compilation', generator.choice(['<true/>', '<false/>'])))
+    if generator.random() < 0.1:
+        fields.append(('Artwork', '<data>\n\t\t\tAQEAAw==\n\t\t\t</data>'))
+    if generator.random() < 0.95:
+        fields.append(('Location', '<string>%s</string>' % get_fuzzed_location(generator, name)))
+    if generator.random() < 0.3:
+        generator.shuffle(fields)
+
+    lines.append('\t\t<key>%d</key>\n\t\t<dict>\n' % track_id)
+    lines.extend('\t\t\t<key>%s</key>%s\n' % field for field in fields)
+    lines.append('\t\t</dict>\n')
+
+def write_fuzzed_playlist(lines, generator, name, persistent_ID, parent_ID = None, keys = (),
+                          track_ids = None):
+    """Adds the lines of a playlist <dict> with the extra keys given and its items, if any"""
+
+    lines.append('\t\t<dict>\n\t\t\t<key>Name</key><string>%s</string>\n' % name)
+    lines.append('\t\t\t<key>Playlist ID</key><integer>%d</integer>\n' %
+                 generator.randint(1, 10 ** 6))
+    lines.append('\t\t\t<key>Playlist Persistent ID</key><string>%s</string>\n' % persistent_ID)
+    if parent_ID is not None:
+        lines.append('\t\t\t<key>Parent Persistent ID</key><string>%s</string>\n' % parent_ID)
+    lines.extend('\t\t\t<key>%s</key>%s\n' % key for key in keys)
+    if track_ids is not None:
+        if not track_ids and generator.random() < 0.5:
+            lines.append('\t\t\t<key>Playlist Items</key>\n\t\t\t<array/>\n')
+        else:
+            lines.append('\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n')
+            lines.extend('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key><integer>%d</integer>\n'
+                         '\t\t\t\t</dict>\n' % track_id for track_id in track_ids)
+            lines.append('\t\t\t</array>\n')
+    lines.append('\t\t</dict>\n')
+
+def generate_fuzzed_library(location, seed, tracks = DEFAULT_TRACKS,
+                            playlists = DEFAULT_PLAYLISTS, items = DEFAULT_ITEMS):
+    """Writes a small iTunes library xml file full of the unusual cases backends may disagree on
+
+    Tracks miss fields, have them in another order or are listed out of
+    order, names hold character references, locations are encoded in
+    different ways, playlists refer to missing tracks, share names, are
+    empty or sit in folders that don't exist, and the whole file may have
+    no whitespace between elements.
+    """
+
+    generator = random.Random(seed)
+    lines = [PLIST_HEADER.replace("file://localhost/C:/Music/",
+                                  generator.choice(LOCATION_PREFIXES))]
+
+    # TRACKS
+    track_ids = []
+    track_id = FIRST_TRACK_ID
+    for index in range(tracks):
+        track_ids.append(track_id)
+        track_id += generator.randint(1, 3)
+    listed = list(track_ids)
+    if generator.random() < 0.3:
+        generator.shuffle(listed)
+    lines.append('\t<key>Tracks</key>\n\t<dict>\n')
+    for track_id in listed:
+        write_fuzzed_track(lines, generator, track_id)
+    lines.append('\t</dict>\n')
+
+    # PLAYLISTS
+    lines.append('\t<key>Playlists</key>\n\t<array>\n')
+    write_fuzzed_playlist(lines, generator, "Library", get_persistent_ID(generator),
+                          keys = [('Master', '<true/>'), ('Visible', '<false/>'),
+                                  ('All Items', '<true/>')], track_ids = track_ids)
+    write_fuzzed_playlist(lines, generator, "Music", get_persistent_ID(generator),
+                          keys = [('Distinguished Kind', '<integer>4</integer>'),
+                                  ('All Items', '<true/>')], track_ids = track_ids)
+    folders = [None]
+    names = []
+    for index in range(playlists):
+        persistent_ID = get_persistent_ID(generator)
+        parent_ID = generator.choice(folders)
+        if generator.random() < 0.03:
+            parent_ID = get_persistent_ID(generator)
+        if names and generator.random() < 0.1:
+            name = generator.choice(names)
+        else:
+            name = get_fuzzed_text(generator, generator.randint(1, 3)) + " " + str(index)
+        names.append(name)
+
+        # folders can contain playlists and other folders
+        if generator.random() < 0.1:
+            write_fuzzed_playlist(lines, generator, name, persistent_ID, parent_ID,
+                                  keys = [('Folder', '<true/>')])
+            folders.append(persistent_ID)
+            continue
+
+        keys = [('All Items', '<true/>')]
+        if generator.random() < 0.2:
+            keys.append(('Smart Info', '<data>\n\t\t\tAQEAAw==\n\t\t\t</data>'))
+        length = int(generator.expovariate(1.0 / max(items, 1)))
+        playlist_track_ids = []
+        for item in range(length):
+            if generator.random() < 0.05:
+                playlist_track_ids.append(track_ids[-1] + generator.randint(1, 1000))
+            else:
+                playlist_track_ids.append(generator.choice(track_ids))
+        write_fuzzed_playlist(lines, generator, name, persistent_ID, parent_ID, keys,
+                              playlist_track_ids if length or generator.random() < 0.5 else None)
+    lines.append('\t</array>\n</dict>\n</plist>\n')
+
+    contents = "".join(lines)
+    if generator.random() < 0.3:
+        contents = sub(r">\s+<", "><", contents)
+    file = open(location, 'w', encoding = "utf-8")
+    file.write(contents)
+    file.close()
+
+def read_library(xml_file, backend):
+    """Reads a library with a backend and resolves all of its playlists
+
+    Returns the library, the playlists to export and a snapshot of every
+    track and resolved playlist to compare between backends.
+    """
+
+    library = iTunes_Library(xml_file, backend)
+    library.get_playlists()
+    for playlist in library.playlists:
+        playlist.set_items()
+    playlists = library.get_selection([], True)
+
+    # every track of the library, whether a playlist refers to it or not
+    track_index = library.parser.track_index
+    tracks = {}
+    for track_dict in library.parser.get_track_dicts():
+        track_id = library.parser.get_track_id(track_dict)
+        track = track_index.get(track_id)
+        tracks[track_id] = (track.location, track.length, track.name, track.artist)
+
+    resolved = [(playlist.persistent_ID, playlist.name, playlist.parent_ID, playlist.is_folder,
+                 playlist.is_smart, playlist.depth, playlist.missing,
+                 [(item.location, item.length, item.name, item.artist)
+                  for item in playlist.items])
+                for playlist in library.playlists]
+    snapshot = {'music_folder' : library.get_music_folder(), 'tracks' : tracks,
+                'playlists' : resolved}
+    return library, playlists, snapshot
+
+def render_reference(playlists, formats):
+    """Renders every playlist in memory, returning the encoded contents by manifest key"""
+
+    rendered = {}
+    for writer in get_writers(playlists, formats, tempfile.gettempdir()):
+        rendered[writer.playlist.persistent_ID + writer.extension] = (
+            writer.render().encode(writer.encoding, writer.errors))
+    return rendered
+
+def render_streamed(playlists, formats, spill_size, buffer_size):
+    """Exports every playlist to a temporary directory through the streaming writers, with
+    small buffers so chunks are split and spilled to disk, returning the files by manifest key"""
+
+    export_location = tempfile.mkdtemp(prefix = "pyTunes_Compare")
+    sizes = pyTunes_Export.OUTPUT_SPILL_SIZE, pyTunes_Export.RENDER_BUFFER_SIZE
+    pyTunes_Export.OUTPUT_SPILL_SIZE, pyTunes_Export.RENDER_BUFFER_SIZE = spill_size, buffer_size
+    try:
+        manifest = export(playlists, formats, export_location, sync = "none")
+        rendered = {}
+        for key, entry in manifest.entries.items():
+            file = open(os.path.join(export_location, entry['file']), 'rb')
+            rendered[key] = file.read()
+            file.close()
+    finally:
+        pyTunes_Export.OUTPUT_SPILL_SIZE, pyTunes_Export.RENDER_BUFFER_SIZE = sizes
+        shutil.rmtree(export_location)
+    return rendered
+
+def run_backend(xml_file, backend, formats, streamed, spill_size, buffer_size):
+    """Reads and renders a library with a backend, with the output of the library code
+    suppressed, returning the snapshot, the rendered files and the seconds of each step"""
+
+    devnull = open(os.devnull, 'w')
+    try:
+        with redirect_stdout(devnull), redirect_stderr(devnull):
+            start = time.perf_counter()
+            library, playlists, snapshot = read_library(xml_file, backend)
+            read = time.perf_counter() - start
+            start = time.perf_counter()
+            if streamed:
+                rendered = render_streamed(playlists, formats, spill_size, buffer_size)
+            else:
+                rendered = render_reference(playlists, formats)
+            write = time.perf_counter() - start
+    finally:
+        devnull.close()
+    return snapshot, rendered, {'read' : read, 'write' : write}
+
+def get_snapshot_differences(expected, got):
+    """Returns a description of each way the snapshot of a backend differs from the reference"""
+
+    differences = []
+    if not expected['music_folder'] == got['music_folder']:
+        differences.append("music folder " + repr(got['music_folder']) + " should be " +
+                           repr(expected['music_folder']))
+
+    for track_id in sorted(set(expected['tracks']) | set(got['tracks'])):
+        if not expected['tracks'].get(track_id) == got['tracks'].get(track_id):
+            differences.append("track " + str(track_id) + " is " +
+                               repr(got['tracks'].get(track_id)) + ", should be " +
+                               repr(expected['tracks'].get(track_id)))
+
+    if not len(expected['playlists']) == len(got['playlists']):
+        differences.append(str(len(got['playlists'])) + " playlists, should be " +
+                           str(len(expected['playlists'])))
+    fields = ("persistent ID", "name", "parent ID", "folder", "smart", "depth", "missing")
+    for wanted, playlist in zip(expected['playlists'], got['playlists']):
+        for field, wanted_value, value in zip(fields, wanted, playlist):
+            if not wanted_value == value:
+                differences.append("playlist " + repr(wanted[1]) + " " + field + " is " +
+                                   repr(value) + ", should be " + repr(wanted_value))
+        for position, (wanted_item, item) in enumerate(zip(wanted[-1], playlist[-1])):
+            if not wanted_item == item:
+                differences.append("playlist " + repr(wanted[1]) + " item " + str(position) +
+                                   " is " + repr(item) + ", should be " + repr(wanted_item))
+                break
+        if not len(wanted[-1]) == len(playlist[-1]):
+            differences.append("playlist " + repr(wanted[1]) + " has " + str(len(playlist[-1])) +
+                               " items, should have " + str(len(wanted[-1])))
+    return differences
+
+def get_file_differences(expected, got):
+    """Returns a description of each rendered file that differs from the reference, pointing
+    at the first line that differs"""
+
+    differences = []
+    for key in sorted(set(expected) | set(got)):
+        if key not in got:
+            differences.append(key + " was not written")
+        elif key not in expected:
+            differences.append(key + " should not have been written")
+        elif not expected[key] == got[key]:
+            wanted_lines = expected[key].splitlines(True)
+            lines = got[key].splitlines(True)
+            number = 0
+            while (number < min(len(lines), len(wanted_lines)) and
+                   lines[number] == wanted_lines[number]):
+                number += 1
+            wanted_line = wanted_lines[number] if number < len(wanted_lines) else b""
+            line = lines[number] if number < len(lines) else b""
+            differences.append(key + " line " + str(number + 1) + " is " + repr(line[:80]) +
+                               ", should be " + repr(wanted_line[:80]))
+    return differences
+
+def compare_library(xml_file, backends, formats, spill_size, buffer_size, totals):
+    """Compares every backend against the reference on a library, adding up the seconds taken
+
+    Every backend is read and streamed to disk, and compared with the
+    reference backend rendered in memory, so the reference backend itself
+    checks the streaming writers. Returns the descriptions of the differences
+    found for each backend.
+    """
+
+    reference, expected, seconds = run_backend(xml_file, REFERENCE_BACKEND, formats, False,
+                                               spill_size, buffer_size)
+    totals.setdefault("reference", {'read' : 0, 'write' : 0})
+    for step in seconds:
+        totals["reference"][step] += seconds[step]
+
+    results = {}
+    for backend in backends:
+        snapshot, rendered, backend_seconds = run_backend(xml_file, backend, formats, True,
+                                                          spill_size, buffer_size)
+        totals.setdefault(backend, {'read' : 0, 'write' : 0})
+        for step in backend_seconds:
+            totals[backend][step] += backend_seconds[step]
+        results[backend] = (get_snapshot_differences(reference, snapshot) +
+                            get_file_differences(expected, rendered))
+    return results
+
+def get_ratio(seconds, reference):
+    """Returns the seconds taken relative to the reference, as printed in the results"""
+
+    if reference <= 0:
+        return "n/a"
+    return "%.2fx" % (seconds / reference)
+
+def print_totals(totals):
+    """Prints the seconds each backend took to read and to write, relative to the reference"""
+
+    reference = totals["reference"]
+    print("Seconds taken, relative to " + REFERENCE_BACKEND + " rendered in memory:")
+    for backend in ["reference"] + sorted(name for name in totals if not name == "reference"):
+        start = " " * 4 + (REFERENCE_BACKEND + " in memory" if backend == "reference" else
+                           backend + " streamed")
+        end = ", ".join("%s %.3f s %s" % (step, totals[backend][step],
+                                          get_ratio(totals[backend][step], reference[step]))
+                        for step in ('read', 'write'))
+        print(start + " " * max(TABLE_WIDTH - len(start), 1) + end)
+
+def command_line_args():
+    """Set up command line arguments"""
+
+    parser = argparse.ArgumentParser(description = "Check that every parser backend and the " +
+                                     "streaming writers give the same playlists as the " +
+                                     REFERENCE_BACKEND + " backend")
+    parser.add_argument('libraries', nargs = '*',
+                        help = "iTunes library xml files to compare on as well as the " +
+                        "generated and fuzzed ones")
+    parser.add_argument('-b', '--backend', nargs = '*', choices = BACKENDS, default = BACKENDS,
+                        help = "specify the backends to compare against " + REFERENCE_BACKEND)
+    parser.add_argument('-e', '--extension', nargs = '*', type = str.lower,
+                        choices = sorted(WRITERS), default = FORMATS,
+                        help = "specify the formats to compare")
+    parser.add_argument('-n', '--fuzzed', type = int, default = DEFAULT_LIBRARIES,
+                        help = "number of fuzzed libraries to compare on")
+    parser.add_argument('--tracks', type = int, default = DEFAULT_GENERATED_TRACKS,
+                        help = "number of tracks in the generated library, 0 to skip it")
+    parser.add_argument('--fuzzed-tracks', type = int, default = DEFAULT_TRACKS,
+                        help = "number of tracks in each fuzzed library")
+    parser.add_argument('--fuzzed-playlists', type = int, default = DEFAULT_PLAYLISTS,
+                        help = "number of playlists in each fuzzed library")
+    parser.add_argument('--items', type = int, default = DEFAULT_ITEMS,
+                        help = "average number of items in a fuzzed playlist")
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = "seed of the first generated library, each fuzzed library " +
+                        "uses the next one")
+    parser.add_argument('--spill-size', type = int, default = DEFAULT_SPILL_SIZE,
+                        help = "bytes of a playlist kept in memory before it is streamed to " +
+                        "disk while comparing")
+    parser.add_argument('--buffer-size', type = int, default = DEFAULT_BUFFER_SIZE,
+                        help = "characters rendered before they are encoded while comparing")
+    parser.add_argument('--keep', metavar = 'DIRECTORY',
+                        help = "save the generated libraries that showed differences here")
+    return parser.parse_args()
+
+##################################################################
+## BODY
+##################################################################
+
+if __name__ == "__main__":
+    args = command_line_args()
+    backends = args.backend
+    work_location = tempfile.mkdtemp(prefix = "pyTunes_Compare")
+
+    # the libraries given, then a generated one and the fuzzed ones
+    libraries = [(location, False) for location in args.libraries]
+    if args.tracks:
+        location = os.path.join(work_location, "generated-" + str(args.seed) + ".xml")
+        generate_library(location, args.tracks, seed = args.seed)
+        libraries.append((location, True))
+    for index in range(args.fuzzed):
+        seed = args.seed + index + 1
+        location = os.path.join(work_location, "fuzzed-" + str(seed) + ".xml")
+        generate_fuzzed_library(location, seed, args.fuzzed_tracks, args.fuzzed_playlists,
+                                args.items)
+        libraries.append((location, True))
+
+    totals = {}
+    failed = 0
+    try:
+        for location, generated in libraries:
+            try:
+                results = compare_library(location, backends, args.extension, args.spill_size,
+                                          args.buffer_size, totals)
+            except Exception as error:
+                frame = traceback.extract_tb(error.__traceback__)[-1]
+                results = {'all' : ["comparing failed: " + type(error).__name__ + ": " +
+                                    str(error) + " at " + os.path.basename(frame.filename) +
+                                    ":" + str(frame.lineno)]}
+
+            outcome = ", ".join(backend + (" OK" if not differences else
+                                           " " + str(len(differences)) + " differences")
+                                for backend, differences in sorted(results.items()))
+            print(os.path.basename(location) + ": " + outcome)
+            if not any(results.values()):
+                continue
+
+            failed += 1
+            for backend, differences in sorted(results.items()):
+                for difference in differences[:MAX_DIFFERENCES]:
+                    print(" " * 4 + backend + ": " + difference)
+                if len(differences) > MAX_DIFFERENCES:
+                    print(" " * 4 + backend + ": ... and " +
+                          str(len(differences) - MAX_DIFFERENCES) + " more")
+            if generated and args.keep is not None:
+                if not os.path.isdir(args.keep):
+                    os.makedirs(args.keep)
+                shutil.copy(location, args.keep)
+                print(" " * 4 + "saved to " + os.path.join(args.keep, os.path.basename(location)))
+    finally:
+        shutil.rmtree(work_location)
+
+    if totals.get("reference"):
+        print_totals(totals)
+    print(str(len(libraries) - failed) + " of " + str(len(libraries)) +
+          " libraries gave the same output with every backend.")
+    if failed:
+        sys.exit(1)
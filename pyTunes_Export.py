@@ -1,10 +1,19 @@
-import os, sys, argparse, codecs, getpass
-from xml.dom.minidom import parse
-from urllib.parse import unquote
-from platform import system
-from re import search, sub
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename, askdirectory
+import time
+START_TIME = time.perf_counter() # taken before the other imports to time the start up
+import os, sys, argparse, codecs, pickle, hashlib, json, mmap, errno
+from xml.etree.ElementTree import iterparse, fromstring, XMLPullParser
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from contextlib import contextmanager
+from urllib.parse import unquote, quote
+from xml.sax.saxutils import unescape
+from re import sub, compile, escape, DOTALL, error as RegexError
+from fnmatch import translate
+
+# tkinter, minidom, the profilers and the modules only needed once the library
+# has been read are imported where they are used, so runs start parsing sooner
+# and headless runs work without a display
 
 ##################################################################
 ## CONSTANTS
@@ -12,7 +21,81 @@ from tkinter.filedialog import askopenfilename, askdirectory
 
 DEBUG = False
 SETTINGS_NAME = "settings" # name for the settings file
+CONFIG_NAME = "pyTunes_Export" # name for the config file
+CONFIG_SECTION = "export" # section of the config file holding the settings
+ENVIRONMENT_PREFIX = "PYTUNES_EXPORT_" # prefix of environment variables holding settings
+CACHE_NAME = "library_cache" # name for the parsed library cache file
+CACHE_VERSION = 3 # version of the cache layout, bump when the document layout changes
+FILE_CACHE_NAME = "file_cache" # name for the cache of the track files found to exist
+FILE_CACHE_VERSION = 1 # version of the file cache layout
+HASH_CHUNK_SIZE = 1 << 20 # number of bytes read at a time when hashing a file
+XML_CHUNK_SIZE = 1 << 20 # number of bytes fed at a time to the lazy parser
+MANIFEST_NAME = ".pyTunes_Export.json" # name for the manifest kept in the export directory
+MANIFEST_VERSION = 1 # version of the manifest layout
 DEFAULT_FORMAT = "M3U8" # default format to export playlists in
+DEFAULT_BACKEND = "stream" # default parser used to read the library
+DEFAULT_JOBS = 1 # default number of playlists written at the same time
+SYNC_MODES = ("batch", "file", "none") # ways to flush the files written to disk
+DEFAULT_SYNC = "batch" # default way to flush the files written to disk
+CONFLICT_POLICIES = ("ask", "overwrite", "rename", "skip") # ways to handle existing files
+MEDIA_MODES = ("copy", "link") # ways to put the audio of the playlists in the export directory
+DEFAULT_MEDIA_DIR = "Media" # default directory in the export directory holding the audio
+DEFAULT_MEDIA_JOBS = 4 # default number of audio files copied at the same time
+MEDIA_EXTERNAL_DIR = "External" # directory of the audio from outside the Music Folder
+MEDIA_MTIME_TOLERANCE = 2 # seconds copies may differ by on file systems with coarse times
+DEFAULT_VERIFY_JOBS = 16 # default number of track files checked at the same time
+WATCH_INTERVAL = 2 # default number of seconds between checks of the library in watch mode
+WATCH_SETTLE = 1 # number of seconds the library must stay unchanged before it is read again
+DEFAULT_BATCH_WRITERS = 4 # default number of libraries written at the same time in batch mode
+REPORT_FORMATS = ("csv", "json") # formats of the library reports
+DEFAULT_REPORT_TOP = 100 # default number of rows in the artist, duplicate and overlap reports
+
+# columns of each library report, also the names of the CSV files
+REPORT_COLUMNS = {
+    "summary" : ("tracks", "playlists", "artists", "seconds", "duplicate_titles",
+                 "missing_items"),
+    "playlists" : ("name", "path", "id", "items", "tracks", "duplicate_items", "seconds"),
+    "artists" : ("artist", "tracks", "seconds", "playlist_items"),
+    "duplicates" : ("name", "artist", "copies", "track_ids", "playlists"),
+    "overlap" : ("playlist", "other_playlist", "shared_tracks", "similarity"),
+}
+
+# settings that apply to the whole batch and can't be given in a section of the manifest
+BATCH_SETTINGS = ("batch", "batch_parsers", "batch_writers", "headless", "watch",
+                  "watch_interval", "profile", "trace_memory", "clear_cache", "stats_json")
+PLIST_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ" # format of <date> values in the library
+RENDER_BUFFER_SIZE = 1 << 16 # number of characters rendered before they are encoded together
+OUTPUT_SPILL_SIZE = 1 << 22 # number of bytes of a playlist kept in memory before writing it out
+
+# writer classes by the extension of the files they write, see Playlist_Writer
+WRITERS = {}
+
+# characters replaced by entities in XML text and attributes, and the control
+# characters XML can't hold, which are dropped
+XML_ESCAPES = str.maketrans({"&" : "&amp;", "<" : "&lt;", ">" : "&gt;", "\"" : "&quot;"})
+XML_ESCAPES.update(dict.fromkeys(code for code in range(32) if chr(code) not in "\t\n\r"))
+
+# keys of each track <dict> kept by the streaming parser, the rest are discarded
+TRACK_FIELDS = ("Track ID", "Name", "Artist", "Total Time", "Location")
+
+# a track <dict> in the Tracks section of the library, keyed by its Track ID
+TRACK_DICT_PATTERN = compile(rb"<key>(\d+)</key>\s*(<dict>.*?</dict>)", DOTALL)
+
+# the Music Folder key at the top of the library
+MUSIC_FOLDER_PATTERN = compile(rb"<key>Music Folder</key>\s*<string>(.*?)</string>")
+
+# path separator of this system and the one replaced by it
+PATH_SEPARATOR = os.sep
+OTHER_SEPARATOR = "/" if PATH_SEPARATOR == "\\" else "\\"
+
+# a Windows drive at the start of the path of a file:// URL
+DRIVE_PATTERN = compile(r"/[A-Za-z]:")
+
+# a Windows drive at the start of a path
+DRIVE_PATH_PATTERN = compile(r"[A-Za-z]:/")
+
+# characters of playlist and folder names that would split a file name into directories
+FILE_NAME_PATTERN = compile(r"[\\/\x00]")
 
 TAB_SIZE = 4 # number of spaces in a tab
 TABLE_WIDTH = 50 # width of table used to print playlists
@@ -21,175 +104,574 @@ TABLE_WIDTH = 50 # width of table used to print playlists
 ## CLASSES
 ##################################################################
 class iTunes_Library_Parser():
+    """Reads an iTunes Library with minidom and decodes its top level <dict>
 
-    def __init__(self, xml_file, document = None):
+    The document is the top level <dict> of the library turned into a dict of
+    typed values. Each <dict> is decoded in a single walk over its children,
+    so looking up a key of a track or playlist no longer searches the DOM.
+    """
+
+    def __init__(self, xml_file, document = None, track_index = None):
         if DEBUG:
             print("Called iTunes Library Parser constructor")
         self.xml_file = xml_file
         self.document = document
         if document is None:
-            self.document = parse(self.xml_file)
-        self.FIRST_TRACK_DICT = 3
-        self.TRACK_DICT_SKIP = 4
-        self.TRACK_DICT_ID = 2
+            self.document = self.parse(self.xml_file)
+        self.track_index = track_index
+        if track_index is None:
+            self.track_index = self.get_track_index()
 
     def __str__(self):
         return "iTunes Library located at " + str(self.xml_file)
 
+    def parse(self, xml_file):
+        """Loads the library document and returns its decoded top level <dict>"""
+
+        from xml.dom import minidom
+        dom = minidom.parse(xml_file)
+        record = {}
+        for node in dom.documentElement.childNodes:
+            if node.nodeType == node.ELEMENT_NODE:
+                record = self.get_record(node)
+                break
+
+        # break the cycles of the DOM so its memory is freed right away
+        dom.unlink()
+        return record
+
+    def get_track_index(self):
+        """Returns a new index of the tracks in this library"""
+        return Track_Index(self)
+
+    def get_record(self, node):
+        """Returns a dict of the keys and decoded values of a <dict> node"""
+
+        record = {}
+        key = None
+
+        # children alternate between a <key> and the element holding its value
+        for child in node.childNodes:
+            if not child.nodeType == child.ELEMENT_NODE:
+                continue
+            if key is None:
+                key = self.get_text(child)
+            else:
+                record[key] = self.get_element_value(child)
+                key = None
+        return record
+
+    def get_element_value(self, node):
+        """Returns the Python value of a plist value node"""
+
+        tag = node.nodeName
+        if tag == "dict":
+            return self.get_record(node)
+        if tag == "array":
+            return [self.get_element_value(child) for child in node.childNodes
+                    if child.nodeType == child.ELEMENT_NODE]
+        return decode_plist_value(tag, self.get_text(node))
+
+    def get_text(self, node):
+        """Returns the text contained directly in a node"""
+        return "".join(child.nodeValue for child in node.childNodes
+                       if child.nodeType == child.TEXT_NODE)
+
     def get_key(self, node, key_name):
-        """return a node of tag name "key" with given name if it exists, else returns None"""
-        
-        keys = node.getElementsByTagName("key")
-        for key in keys:
-            if key.nodeType == key.ELEMENT_NODE:
-                # return the first key with the specified name found
-                if key.childNodes[0].nodeValue == key_name:
-                    return key
+        """returns key_name if the record has a value for it, else returns None"""
+        if key_name in node:
+            return key_name
         return None
 
     def get_tracks_node(self):
-        """Returns the <dict> node containing all of the track information"""
-
-        tracks_key = self.get_key(self.document, "Tracks")
-        return tracks_key.nextSibling.nextSibling
+        """Returns the dict containing the record of every track"""
+        return self.document.get("Tracks", {})
 
     def get_track_dicts(self):
-        """Returns a list of <dict>s for each track in the library"""
-
-        # set initial variables
-        root_dict = self.get_tracks_node()
-        track_dicts = []
-        tracks_left = True
-        index = 1
-
-        # while there are tracks left
-        while tracks_left:
+        """Returns a list of records for each track in the library"""
+        return list(self.get_tracks_node().values())
 
-            # try to get the corresponding child node to the index
-            try:
-                track_dict = root_dict.childNodes[self.FIRST_TRACK_DICT +
-                                                  self.TRACK_DICT_SKIP * index]
+    def get_track_id(self, track_dict):
+        """Returns the Track ID of the given track record"""
+        return track_dict["Track ID"]
 
-            # if the index doesn't exist, there are no more tracks, quit the loop
-            except IndexError:
-                tracks_left = False
-                break
+    def get_playlist_nodes(self):
+        """Returns a list of records for each playlist in the library"""
+        return self.document.get("Playlists", [])
 
-            # add the track to the list, increment the index
-            else:
-                track_dicts.append(track_dict)
-                index += 1
+    def get_playlist_parser(self, node):
+        """Returns a parser for the given playlist record sharing this library's document"""
+        return Playlist_Parser(node, self.xml_file, self.document, self.track_index)
 
-        return track_dicts
-                
-        
     def get_key_value(self, node, to_find):
         """Finds the value of the key given if the key exists, otherwise returns None"""
-        key = None
-        key_node = self.get_key(node, to_find)
-        if key_node is not None:
-            key = key_node.nextSibling.childNodes[0].nodeValue
-        return key
+        return node.get(to_find)
 
     def get_key_bool_value(self, node, to_find):
         """Finds the boolean value of the key given if the key exists, otherwise returns None"""
-        key = None
-        key_node = self.get_key(node, to_find)
-        if key_node is not None:
-            key = key_node.nextSibling.nodeName
-        return key
+        value = node.get(to_find)
+        if value is not None:
+            value = value is True
+        return value
 
     def get_track_info(self, track_dict):
-        """Returns a string with the location on disk of a track with the given ID"""
-        
-        info = {}
+        """Returns the Track holding the information of a track record needed to export it"""
         
-        # get and process the length by getting windows path and removing percent encoding
+        # turn the file:// URL of the track into a path
         raw = self.get_key_value(track_dict, "Location")
-        trimmed = search(r"[A-Z]:.*", raw)
-        info['location'] = normalize_path(unquote(trimmed.group(0)))
+        location = None
+        if raw is not None:
+            location = self.track_index.rewriter.rewrite(raw)
 
         # get and process the total time in seconds
         milliseconds = self.get_key_value(track_dict, "Total Time")
-        info['length'] = int(milliseconds)/1000
+        length = int(milliseconds or 0)/1000
 
-        # get and process song and artist name
-        info['name'] = self.get_key_value(track_dict, "Name")
-        info['artist'] = self.get_key_value(track_dict, "Artist")
+        # get and process song and artist name, artists are shared by many tracks
+        name = self.get_key_value(track_dict, "Name")
+        artist = self.get_key_value(track_dict, "Artist")
+        if artist is not None:
+            artist = sys.intern(artist)
 
-        return info
+        return Track(location, length, name, artist)
             
 
 class Playlist_Parser(iTunes_Library_Parser):
     """Contains relevant information and method for a playlist"""
 
-    def __init__(self, node, xml_file, document = None):
+    def __init__(self, node, xml_file, document = None, track_index = None):
         self.node = node
-        super().__init__(xml_file, document)
+        super().__init__(xml_file, document, track_index)
 
     def get_track_ids(self):
-        """Returns an array of all the items in the playlist node"""
+        """Returns a list of all the Track IDs in the playlist record"""
+        return [item["Track ID"] for item in self.node.get("Playlist Items", [])]
 
-        # variable initialization
-        array = None
-        items = []
+    def get_track_rows(self, track_ids = None):
+        """Gets the rows in the track index of the given track IDs in playlist order"""
 
-        # find the tag in the playlist named array
-        arrays = self.node.getElementsByTagName("array")
+        # initialize rows as an empty array
+        rows = array('l')
 
-        # if the tag doesn't exist, return an empty list of items
-        try:
-            array = arrays[0]
-        except IndexError:
-            return []
+        # get track ids if not given
+        if track_ids is None:
+            track_ids = self.get_track_ids()
 
-        # loop the <dict>s containing Track IDs, add the Track IDs to items list
-        current_dict = array.childNodes[0].nextSibling
-        while current_dict is not None:
-            track_id = int(current_dict.childNodes[0].nextSibling.nextSibling.childNodes[0].nodeValue)
-            items.append(track_id)
-            current_dict = current_dict.nextSibling.nextSibling
+        # look up each item in the library's track index, keeping duplicates
+        for track_id in track_ids:
+            row = self.track_index.get_row(track_id)
+            if row is None:
+                sys.stderr.write("Could not find track with ID " + str(track_id) + "!\n")
+            else:
+                rows.append(row)
 
-        return items
+        return rows
 
     def get_tracks_info(self, track_ids = None):
-        """Gets the locations on disk of the songs with the given track IDs"""
+        """Gets the Tracks with the given track IDs in playlist order"""
+        return self.track_index.get_tracks(self.get_track_rows(track_ids))
+
+
+class iTunes_Library_Stream_Parser(iTunes_Library_Parser):
+    """Reads the tracks and playlists of an iTunes Library in a single streaming pass
+
+    Instead of loading a DOM, each track and playlist <dict> is decoded as soon
+    as it has been read and then discarded, so only the records themselves are
+    kept in memory. The document has the same layout as the minidom backend's,
+    except that tracks only keep TRACK_FIELDS and "Playlist Items" is a plain
+    list of Track IDs.
+    """
+
+    def parse(self, xml_file):
+        """Walks the Tracks and Playlists of the library once, returning their records"""
+        return self.parse_events(iterparse(xml_file, events = ("start", "end")))
+
+    def parse_events(self, events):
+        """Returns the records of the tracks and playlists read from start and end events"""
+
+        document = {"Tracks": {}, "Playlists": []}
+        for section, record in self.iter_records(events):
+            if section == "Tracks":
+                document["Tracks"][record["Track ID"]] = record
+            elif section == "Playlists":
+                document["Playlists"].append(record)
+            elif section not in document:
+                document[section] = record
+        return document
+
+    def iter_records(self, events, last_section = None):
+        """Yields the section and record of each track and playlist read from start and end
+        events, along with the section and value of every other top level key
+
+        When last_section is given, reading stops at the end of that section.
+        """
+
+        section = None
+        container = None
+        depth = 0
+
+        for event, element in events:
+            if event == "start":
+                depth += 1
+
+                # remember the <dict> or <array> holding the current section
+                if depth == 3:
+                    container = element
+                continue
+
+            # top level keys name the section their value belongs to
+            if depth == 3:
+                if element.tag == "key":
+                    section = element.text
+                else:
+                    if section not in ("Tracks", "Playlists"):
+                        yield section, self.get_element_value(element)
+                    if section == last_section:
+                        return
+                    section = None
+                    element.clear()
+
+            # decode each track or playlist, then drop it from the tree
+            elif depth == 4 and element.tag == "dict":
+                if section == "Tracks":
+                    record = self.get_record(element, TRACK_FIELDS)
+                    container.clear()
+                    yield section, record
+                elif section == "Playlists":
+                    record = self.get_record(element)
+                    if "Playlist Items" in record:
+                        record["Playlist Items"] = array('q', (item["Track ID"] for item in
+                                                               record["Playlist Items"]))
+                    container.clear()
+                    yield section, record
+
+            depth -= 1
+
+    def get_record(self, element, fields = None):
+        """Returns a dict of the keys and decoded values of a <dict> element"""
+
+        record = {}
+        children = iter(element)
+        for key in children:
+            value = next(children)
+            if fields is None or key.text in fields:
+                record[key.text] = self.get_element_value(value)
+        return record
+
+    def get_element_value(self, element):
+        """Returns the Python value of a plist value element"""
+
+        tag = element.tag
+        if tag == "dict":
+            return self.get_record(element)
+        if tag == "array":
+            return [self.get_element_value(child) for child in element]
+        return decode_plist_value(tag, element.text or "")
+
+    def get_playlist_parser(self, node):
+        """Returns a parser for the given playlist record sharing this library's records"""
+        return Playlist_Stream_Parser(node, self.xml_file, self.document, self.track_index)
+
+
+class Playlist_Stream_Parser(Playlist_Parser, iTunes_Library_Stream_Parser):
+    """Contains relevant information and method for a playlist record"""
 
-        # initialize tracks as an empty list
-        tracks = []
+    def get_track_ids(self):
+        """Returns a list of all the Track IDs in the playlist record"""
+        return self.node.get("Playlist Items", [])
+
+
+class iTunes_Library_Lazy_Parser(iTunes_Library_Stream_Parser):
+    """Reads the playlists of a memory-mapped iTunes Library, decoding tracks only when needed
+
+    Instead of track records, the document holds a "Track Offsets" index of
+    the Track IDs in the library along with the byte offset and length of each
+    track <dict> in the file. A track is decoded from its slice of the file
+    the first time a playlist refers to it, so exporting a few playlists only
+    pays for the tracks in them.
+    """
+
+    def parse(self, xml_file):
+        """Indexes the track <dict>s and streams the playlists of the library"""
+
+        track_offsets = self.index_tracks()
+
+        # stream the playlists as if they were the only key of the library
+        document = self.parse_events(self.iter_events(self.playlists_start))
+        document["Track Offsets"] = track_offsets
+
+        # the Music Folder is the only other key needed, find it ahead of the tracks
+        match = MUSIC_FOLDER_PATTERN.search(self.get_mapping(), 0, self.tracks_start)
+        if match is not None:
+            document["Music Folder"] = decode_plist_value("string", unescape(
+                match.group(1).decode("utf-8")))
+        return document
+
+    def index_tracks(self):
+        """Returns the Track IDs in the library along with the offset and length of their
+        <dict>s, sorted by Track ID, and sets the offset of the Playlists key"""
+
+        mapping = self.get_mapping()
+        tracks_start = mapping.find(b"<key>Tracks</key>")
+        playlists_start = mapping.find(b"<key>Playlists</key>", max(tracks_start, 0))
+        if tracks_start == -1 or playlists_start == -1:
+            raise ValueError(str(self.xml_file) + " has no Tracks or Playlists")
+        self.tracks_start = tracks_start
+        self.playlists_start = playlists_start
+
+        # find the slice of the file taken up by each track <dict>
+        ids = array('q')
+        offsets = array('q')
+        lengths = array('q')
+        for match in TRACK_DICT_PATTERN.finditer(mapping, tracks_start, playlists_start):
+            ids.append(int(match.group(1)))
+            offsets.append(match.start(2))
+            lengths.append(match.end(2) - match.start(2))
+
+        # sort the index by Track ID so it can be searched
+        if any(ids[index] > ids[index + 1] for index in range(len(ids) - 1)):
+            order = sorted(range(len(ids)), key = ids.__getitem__)
+            ids = array('q', (ids[index] for index in order))
+            offsets = array('q', (offsets[index] for index in order))
+            lengths = array('q', (lengths[index] for index in order))
+
+        return ids, offsets, lengths
+
+    def get_mapping(self):
+        """Returns the library file mapped into memory, mapping it on first use"""
+
+        if not hasattr(self, "mapping"):
+            library_file = open(self.xml_file, 'rb')
+            self.mapping = mmap.mmap(library_file.fileno(), 0, access = mmap.ACCESS_READ)
+            library_file.close()
+        return self.mapping
+
+    def iter_events(self, start):
+        """Yields the start and end events of the library from the given offset onwards"""
+
+        mapping = self.get_mapping()
+        parser = XMLPullParser(events = ("start", "end"))
+        parser.feed(b"<plist><dict>")
+        for offset in range(start, len(mapping), XML_CHUNK_SIZE):
+            parser.feed(mapping[offset:offset + XML_CHUNK_SIZE])
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+
+    def get_track_index(self):
+        """Returns a new index of the tracks in this library that decodes them lazily"""
+        return Track_Offset_Index(self)
+
+    def get_track_dict(self, track_id):
+        """Decodes the record of the track with the given ID, or returns None if it doesn't exist"""
+
+        ids, offsets, lengths = self.document["Track Offsets"]
+        position = bisect_left(ids, track_id)
+        if position == len(ids) or not ids[position] == track_id:
+            return None
+
+        offset = offsets[position]
+        element = fromstring(self.get_mapping()[offset:offset + lengths[position]])
+        return self.get_record(element, TRACK_FIELDS)
 
-        # get track ids if not given
-        if track_ids is None:
-            track_ids = self.get_track_ids()
+    def get_track_dicts(self):
+        """Returns a list of records for each track in the library"""
+        return [self.get_track_dict(track_id) for track_id in self.document["Track Offsets"][0]]
 
-        track_dicts = self.get_track_dicts()
 
-        for track_dict in track_dicts:
+class Track():
+    """Information about a track needed to export it"""
 
-            # get the track_id from the dict
-            track_id = int(track_dict.childNodes[self.TRACK_DICT_ID].childNodes[0].nodeValue)
+    __slots__ = ("location", "length", "name", "artist")
 
-            # if track_id is in the list of track_ids
-            # get the info of the track and remove the id from the list 
-            if track_id in track_ids:
-                if DEBUG:
-                    print("Found id " + str(track_id))
-                info = self.get_track_info(track_dict)
-                tracks.append(info)
-                track_ids.remove(track_id)
+    def __init__(self, location, length, name, artist):
+        self.location = location
+        self.length = length
+        self.name = name
+        self.artist = artist
+
+    def __str__(self):
+        return str(self.name) + " - " + str(self.artist)
+
+    def get_title(self):
+        """Returns the name and artist of the track joined by a dash, leaving out those missing"""
+        return " - ".join(field for field in (self.name, self.artist) if field)
+
+
+class Location_Rewriter():
+    """Turns the file:// URLs of tracks into paths, rewriting their prefixes by rules
+
+    Each rule is a pair of the prefix to replace, given either as a path or as
+    a file:// URL, and its replacement. The rules are compiled into a single
+    pattern matching the longest prefix that ends at a separator, ignoring case
+    for Windows drive paths. Tracks share a small number of
+    directories, so each directory of a URL is decoded and rewritten once and
+    remembered, leaving only the file name to decode for every track.
+    """
+
+    def __init__(self, rules = ()):
+        self.rules = []
+        for source, target in rules:
+            if source.startswith("file:"):
+                source = self.get_path(unquote(source))
+            self.rules.append((source.replace("\\", "/"), target))
+
+        # longest prefixes first, so the first alternative that matches is the longest
+        self.rules.sort(key = lambda rule: len(rule[0]), reverse = True)
+        self.pattern = None
+        if self.rules:
+            self.pattern = compile("|".join("(" + self.get_rule_pattern(source) + ")"
+                                            for source, target in self.rules))
+        self.directories = {}
+
+    def get_rule_pattern(self, source):
+        """Returns the pattern matching the prefix of a rule up to a separator or the end"""
+
+        pattern = escape(source)
+        if not source.endswith("/"):
+            pattern += "(?=/|$)"
+        if DRIVE_PATH_PATTERN.match(source):
+            pattern = "(?i:" + pattern + ")"
+        return pattern
+
+    def get_path(self, url):
+        """Returns the path of a decoded file:// URL, URLs of other schemes are kept as is
+
+        The host is dropped when it is empty or localhost, any other host is kept
+        in front of the path as a UNC path, such as //server/share/Music.
+        """
+
+        if not url.startswith("file://"):
+            return url
+
+        # drop the local host and the slash before a Windows drive
+        path = url[len("file://"):]
+        start = path.find("/")
+        if start < 0:
+            return ""
+        host = path[:start]
+        if host and host.lower() != "localhost":
+            return "//" + path
+        if DRIVE_PATTERN.match(path, start):
+            start += 1
+        return path[start:]
+
+    def get_directory(self, directory):
+        """Returns the decoded directory of a URL with its prefix rewritten and the
+        separators used for the paths in it, replaced one first"""
+
+        path = self.get_path(unquote(directory))
+        if self.pattern is not None:
+            match = self.pattern.match(path)
+            if match is not None:
+                source, target = self.rules[match.lastindex - 1]
+                separators = ("/", "\\") if "\\" in target else ("\\", "/")
+                rest = path[match.end():].replace(separators[0], separators[1])
+                if target.endswith(separators) and rest.startswith(separators):
+                    rest = rest[1:]
+                return target + rest, separators
+        return normalize_path(path), (OTHER_SEPARATOR, PATH_SEPARATOR)
+
+    def rewrite(self, url):
+        """Returns the path of the track at a Location URL of the library"""
+
+        split = url.rfind("/") + 1
+        directory = url[:split]
+        entry = self.directories.get(directory)
+        if entry is None:
+            entry = self.directories[directory] = self.get_directory(directory)
+        prefix, separators = entry
+        return prefix + unquote(url[split:]).replace(separators[0], separators[1])
+
+
+class Track_Index():
+    """Maps the Track IDs of a library to their tracks, shared by all of its playlists
+
+    The index of track <dict>s is built in a single pass over the library the
+    first time a track is looked up. Each track is resolved into a Track once,
+    the first time a playlist refers to it, and appended to a table of tracks
+    that playlists refer to by row.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.rewriter = Location_Rewriter()
+        self.track_dicts = None
+        self.rows = {}
+        self.tracks = []
+
+    def build(self):
+        """Indexes every track <dict> in the library by its Track ID"""
 
-        # all remaining ids in the list of track ids could not be found
-        for remaining in track_ids:
-            sys.stderr.write("Could not find track with ID " + str(remaining) + "!\n")
+        if DEBUG:
+            print("Building the track index")
+        self.track_dicts = {}
+        for track_dict in self.parser.get_track_dicts():
+            self.track_dicts[self.parser.get_track_id(track_dict)] = track_dict
+
+    def get_track_dict(self, track_id):
+        """Returns the <dict> of the track with the given ID, or None if it doesn't exist"""
+
+        if self.track_dicts is None:
+            self.build()
+        return self.track_dicts.get(track_id)
+
+    def get_row(self, track_id):
+        """Returns the row of the track with the given ID, or None if it doesn't exist"""
+
+        # resolve the track the first time it is asked for
+        row = self.rows.get(track_id)
+        if row is None:
+            track_dict = self.get_track_dict(track_id)
+            if track_dict is not None:
+                row = len(self.tracks)
+                self.tracks.append(self.parser.get_track_info(track_dict))
+                self.rows[track_id] = row
+        return row
+
+    def get(self, track_id):
+        """Returns the Track with the given ID, or None if it doesn't exist"""
+
+        row = self.get_row(track_id)
+        if row is None:
+            return None
+        return self.tracks[row]
+
+    def get_tracks(self, rows):
+        """Returns a list of the Tracks in the given rows"""
+
+        tracks = self.tracks
+        return [tracks[row] for row in rows]
+
+
+class Track_Offset_Index(Track_Index):
+    """Track index of a lazy parser, which decodes each track from the file when it is needed"""
+
+    def get_track_dict(self, track_id):
+        """Returns the record of the track with the given ID, or None if it doesn't exist"""
+        return self.parser.get_track_dict(track_id)
 
-        return tracks
-        
 
 class Playlist():
-    """Information about a playlist"""
+    """Information about a playlist
 
-    def __init__(self, playlists_node, xml_file, document = None):
-        self.parser = Playlist_Parser(playlists_node, xml_file, document)
+    The items of a playlist are kept as an array of rows in the track index of
+    its library, so each Track is stored once no matter how many playlists
+    contain it.
+    """
+
+    __slots__ = ("parser", "name", "persistent_ID", "parent_ID", "is_folder", "is_smart",
+                 "rows", "missing", "parent", "children", "depth")
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.rows = None
+        self.missing = 0
+        self.parent = None
+        self.children = []
+        self.depth = 0
 
     def __str__(self):
         return self.name
@@ -208,10 +690,7 @@ class Playlist():
 
     def set_is_folder(self):
         """Sets the value of self.is_folder by finding the boolean value of "Folder" in the XML"""
-        self.is_folder = False
-        is_folder = self.parser.get_key_bool_value(self.parser.node, "Folder")
-        if is_folder == "true":
-            self.is_folder = True
+        self.is_folder = self.parser.get_key_bool_value(self.parser.node, "Folder") is True
 
     def set_is_smart(self):
         """Sets the value of self.is_smart by finding whether the "Smart Info" key exists in the XML"""
@@ -221,15 +700,24 @@ class Playlist():
         """Sets the list of items in the Playlist"""
         if DEBUG:
             print("Setting items for playlist \"" + self.name + "\"")
-        self.items = self.parser.get_tracks_info()
+        track_ids = self.parser.get_track_ids()
+        self.rows = self.parser.get_track_rows(track_ids)
+        self.missing = len(track_ids) - len(self.rows)
         if DEBUG:
             print("Finished setting info for \"" + self.name + "\"")
 
+    @property
+    def items(self):
+        """The list of Tracks in the Playlist, resolved the first time it is read"""
+        if self.rows is None:
+            self.set_items()
+        return self.parser.track_index.get_tracks(self.rows)
+
     def get_total_length(self):
         """Returns the total length in seconds of this Playlist"""
         total = 0
         for item in self.items:
-            total += item['length']
+            total += item.length
 
         return total
 
@@ -241,194 +729,627 @@ class Playlist():
         self.set_is_folder()
         self.set_is_smart()
 
+    def get_folder_names(self):
+        """Returns the names of the folders containing this Playlist, outermost first"""
+
+        names = []
+        ancestor = self.parent
+        while ancestor is not None and len(names) < self.depth:
+            names.append(ancestor.name)
+            ancestor = ancestor.parent
+        names.reverse()
+        return names
+
+class Library_Cache():
+    """Snapshot of a parsed library document saved to disk for warm starts
+
+    The snapshot is keyed on the path, size and modification time of the
+    library XML, the backend that parsed it and, optionally, a hash of its
+    contents. The key is pickled ahead of the document so a stale snapshot is
+    detected without loading the document. The key is taken before the library
+    is parsed, so a library saved again during the parse leaves a stale snapshot.
+    """
+
+    def __init__(self, location, use_hash = False):
+        self.location = location
+        self.use_hash = use_hash
+
+    def get_key(self, xml_file, backend):
+        """Returns the key identifying the given library file as it is now"""
+
+        stat = os.stat(xml_file)
+        key = {'version' : CACHE_VERSION, 'path' : os.path.abspath(xml_file),
+               'size' : stat.st_size, 'mtime' : stat.st_mtime, 'backend' : backend,
+               'hash' : None}
+        if self.use_hash:
+            key['hash'] = hash_file(xml_file)
+        return key
+
+    def load(self, current):
+        """Returns the cached document of the library, or None if there is no fresh snapshot
+
+        current is the key of the library as it is now, from get_key.
+        """
+
+        # try to open the snapshot, if it fails there is nothing cached
+        try:
+            cache_file = open(self.location, 'rb')
+        except IOError:
+            return None
+
+        document = None
+        try:
+            key = pickle.load(cache_file)
+
+            # only compare hashes if they were asked for
+            if not self.use_hash:
+                key['hash'] = None
+            if key == current:
+                document = pickle.load(cache_file)
+            elif DEBUG:
+                print("Library cache at " + self.location + " is stale")
+        except Exception as error:
+            # a truncated or foreign snapshot can fail in any way while it is unpickled
+            sys.stderr.write("Ignoring unreadable library cache: " + str(error) + "\n")
+        finally:
+            cache_file.close()
+
+        return document
+
+    def save(self, key, document):
+        """Saves the document of the library under the key taken before it was parsed,
+        replacing any previous snapshot"""
+
+        # write to a temporary file first so a crash never leaves a partial snapshot
+        temp_location = self.location + ".tmp"
+        try:
+            cache_file = open(temp_location, 'wb')
+            try:
+                pickle.dump(key, cache_file, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(document, cache_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            os.replace(temp_location, self.location)
+        except (IOError, OSError) as error:
+            sys.stderr.write("Could not save library cache: " + str(error) + "\n")
+
+    def clear(self):
+        """Deletes the snapshot if there is one"""
+
+        try:
+            os.remove(self.location)
+        except OSError:
+            pass
+        else:
+            print("Cleared library cache at " + self.location)
+
+
+class Pattern_Group():
+    """Patterns matched together against each playlist, remembering which ones matched
+
+    Exact names and persistent IDs are looked up in sets, so thousands of them
+    cost no more than one. Globs and regular expressions are compiled once.
+    Unless added as plain names, patterns containing a slash are matched against
+    the path of the playlist through its folders, such as "Folder/Sub Folder/Playlist".
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.paths = {}
+        self.ids = {}
+        self.patterns = []
+        self.matched = set()
+
+    def __len__(self):
+        return len(self.names) + len(self.paths) + len(self.ids) + len(self.patterns)
+
+    def add(self, source, kind, text, use_path = True):
+        """Compiles a pattern of the given kind, raising ValueError if it is not valid
+
+        A name added without use_path is always matched against the name of the
+        playlist, even if it contains a slash.
+        """
+
+        if kind == "id":
+            self.ids[text.upper()] = source
+        elif kind == "name" and use_path and "/" in text:
+            self.paths[text] = source
+        elif kind == "name":
+            self.names[text] = source
+        else:
+            try:
+                if kind == "glob":
+                    pattern = compile(translate(text)).match
+                else:
+                    pattern = compile(text).search
+            except RegexError as error:
+                raise ValueError("invalid pattern " + source + ": " + str(error))
+            self.patterns.append((source, pattern, "/" in text))
+
+    def match(self, playlist, get_path):
+        """Tests whether any pattern matches the playlist, get_path returning its path"""
+
+        found = False
+        for source in (self.names.get(playlist.name),
+                       self.ids.get((playlist.persistent_ID or "").upper())):
+            if source is not None:
+                self.matched.add(source)
+                found = True
+        if self.paths:
+            source = self.paths.get(get_path(playlist))
+            if source is not None:
+                self.matched.add(source)
+                found = True
+        for source, pattern, use_path in self.patterns:
+            if pattern(get_path(playlist) if use_path else playlist.name):
+                self.matched.add(source)
+                found = True
+        return found
+
+    def get_unmatched(self):
+        """Returns the patterns that matched no playlist, in the order they were given"""
+
+        sources = (list(self.names.values()) + list(self.paths.values()) +
+                   list(self.ids.values()) + [source for source, pattern, use_path
+                                              in self.patterns])
+        return [source for source in sources if source not in self.matched]
+
+
+class Playlist_Selector():
+    """Chooses playlists by name, glob, regular expression, persistent ID and folder
+
+    A pattern is a glob matched against the name of a playlist unless it starts
+    with "name:" for an exact name, "re:" for a regular expression or "id:" for
+    a persistent ID. Starting it with "tree:" also selects everything inside the
+    matching folders. A playlist is selected when an included pattern matches
+    it or a folder containing it and no excluded pattern does. Exact names and
+    names of folders to export with their subtree can also be given as is.
+    """
+
+    KINDS = ("name", "glob", "re", "id")
+
+    def __init__(self, include = (), exclude = (), select_all = False, names = (),
+                 subtrees = ()):
+        self.select_all = select_all
+        self.include = Pattern_Group()
+        self.include_tree = Pattern_Group()
+        self.exclude = Pattern_Group()
+        self.exclude_tree = Pattern_Group()
+        for name in names:
+            self.include.add(name, "name", name, False)
+        for name in subtrees:
+            self.include_tree.add(name, "name", name, False)
+        for source in include:
+            self.add(source, self.include, self.include_tree)
+        for source in exclude:
+            self.add(source, self.exclude, self.exclude_tree)
+
+    def add(self, source, group, tree_group):
+        """Compiles a pattern into the group, or into the tree group if it starts with tree:"""
+
+        text = source
+        if text.startswith("tree:"):
+            text = text[len("tree:"):]
+            group = tree_group
+        kind = "glob"
+        for prefix in self.KINDS:
+            if text.startswith(prefix + ":"):
+                kind = prefix
+                text = text[len(prefix) + 1:]
+                break
+        group.add(source, kind, text)
+
+    def is_empty(self):
+        """Tests whether no playlist can be selected"""
+        return not self.select_all and not len(self.include) and not len(self.include_tree)
+
+    def select(self, playlists):
+        """Returns the selected playlists, in the order given, in a single pass over them
+
+        Patterns that included no playlist are reported.
+        """
+
+        paths = {}
+        def get_path(playlist):
+            path = paths.get(playlist.persistent_ID)
+            if path is None:
+                path = paths[playlist.persistent_ID] = "/".join(playlist.get_folder_names() +
+                                                                [playlist.name])
+            return path
+
+        # whether each playlist is in an included or excluded folder, worked out once
+        # for every folder on the way down from the top
+        states = {}
+        def get_state(playlist):
+            # the walk stops at the depth of the playlist, so parents linked in a loop can't hang it
+            chain = []
+            ancestor = playlist
+            while ancestor is not None and ancestor.persistent_ID not in states and \
+                  len(chain) <= playlist.depth:
+                chain.append(ancestor)
+                ancestor = ancestor.parent
+            included, excluded = False, False
+            if ancestor is not None and len(chain) <= playlist.depth:
+                included, excluded = states[ancestor.persistent_ID]
+            for ancestor in reversed(chain):
+                included = self.include_tree.match(ancestor, get_path) or included
+                excluded = self.exclude_tree.match(ancestor, get_path) or excluded
+                states[ancestor.persistent_ID] = (included, excluded)
+            return included, excluded
+
+        selection = []
+        for playlist in playlists:
+            in_included, in_excluded = get_state(playlist)
+            included = self.include.match(playlist, get_path) or in_included
+            if (self.select_all or included) and not in_excluded and \
+               not self.exclude.match(playlist, get_path):
+                if DEBUG:
+                    print("Adding playlist " + playlist.name + " to the selection")
+                selection.append(playlist)
+
+        for group in (self.include, self.include_tree):
+            for source in group.get_unmatched():
+                sys.stderr.write("Item " + source + " not found!\n")
+        return selection
+
+
 class iTunes_Library():
     """Information about an iTunes XML Library"""
 
-    def __init__(self, xml_file):
+    PARSERS = {"minidom" : iTunes_Library_Parser, "stream" : iTunes_Library_Stream_Parser,
+               "lazy" : iTunes_Library_Lazy_Parser}
+
+    def __init__(self, xml_file, backend = DEFAULT_BACKEND, cache = None, rewriter = None,
+                 document = None):
         if DEBUG:
-            print("Called iTunes Library constructor")
+            print("Called iTunes Library constructor with " + backend + " backend")
+        self.xml_file = xml_file
+        self.rewriter = rewriter
+
+        # use the document given, parsed by another process, or the cached
+        # document of the library if it is still fresh
+        key = None
+        if document is None and cache is not None:
+            key = cache.get_key(self.xml_file, backend)
+            document = cache.load(key)
+            if document is not None and not DEBUG:
+                print("Loaded iTunes Library from cache")
+        if document is not None:
+            self.parser = self.PARSERS[backend](self.xml_file, document)
+            self.set_rewriter()
+            return
+
         if not DEBUG:
             print("Parsing iTunes Library XML file ...", end = " ")
-        self.xml_file = xml_file
-        self.parser = iTunes_Library_Parser(self.xml_file)
+        self.parser = self.PARSERS[backend](self.xml_file)
         if not DEBUG:
             print("Done!")
+        if key is not None:
+            cache.save(key, self.parser.document)
+        self.set_rewriter()
+
+    def get_music_folder(self):
+        """Returns the path of the Music Folder of the library, or None if it isn't known"""
+
+        url = self.parser.document.get("Music Folder")
+        if url is None:
+            return None
+        return self.parser.track_index.rewriter.rewrite(url)
+
+    def set_rewriter(self):
+        """Makes the tracks of the library use the location rewriter given, if any"""
+
+        if self.rewriter is not None:
+            self.parser.track_index.rewriter = self.rewriter
 
     def get_playlists(self):
         """Sets the non time consuming information for each playlist (everything except items)"""
 
         # create array to contain Playlist_Parser objects
         self.playlists = []
-        playlists_key = self.parser.get_key(self.parser.document, "Playlists")
-        playlists_node = playlists_key.nextSibling.nextSibling
+        self.playlists_by_ID = {}
 
         # create a Playlist object for each playlist
-        for node in playlists_node.childNodes:
-            if not node.nodeType == node.TEXT_NODE:
-                playlist = Playlist(node, self.xml_file, self.parser.document)
-                playlist.set_quick()
-                self.playlists.append(playlist)
-
-    def get_items(self, playlists, export_all):
-        """Creates Playlist object for each playlist found and adds them to a list"""
+        for playlist in read_playlists(self.parser, self.parser.get_playlist_nodes()):
+            self.playlists.append(playlist)
+            self.playlists_by_ID[playlist.persistent_ID] = playlist
 
-        # get the playlists if necessary
-        if not hasattr(self, "playlists"):
-            self.get_playlists()
+        self.set_hierarchy()
 
-        force_select = False
-        
-        # ask the user to select the playlists to export if none are specified
-        if len(playlists) == 0 and export_all == False:
-            playlists = self.select_playlists()
-            force_select = True
+    def set_hierarchy(self):
+        """Links every playlist to its parent and children and sets its depth in the folders"""
 
-        self.export = []
-        # set the items for the playlists specified to export
+        # link each playlist to its parent, playlists with a missing parent are top level
+        roots = []
         for playlist in self.playlists:
-            if export_all or playlist.name in playlists:
-                if DEBUG:
-                    print("Adding playlist " + playlist.name + " to self.export")
-                playlist.set_items()
-                self.export.append(playlist)
+            playlist.parent = self.playlists_by_ID.get(playlist.parent_ID)
+            if playlist.parent is not None:
+                playlist.parent.children.append(playlist)
+            else:
+                if playlist.parent_ID is not None:
+                    sys.stderr.write("Could not find the folder containing " +
+                                     playlist.name + "!\n")
+                roots.append(playlist)
+
+        # walk down from the top level playlists to set the depths
+        stack = [(playlist, 0) for playlist in roots]
+        while stack:
+            playlist, depth = stack.pop()
+            playlist.depth = depth
+            stack.extend((child, depth + 1) for child in playlist.children)
+
+    def get_items(self, playlists, export_all, subtrees = ()):
+        """Creates Playlist object for each playlist found and adds them to a list"""
 
-        # check to see if any playlists were excluded from self.export
-        if len(playlists) > 0 and not force_select:
+        self.export = self.get_selection(playlists, export_all, subtrees)
 
-            # make list of names of playlists to be exported
-            names_list = []
-            for playlist in self.export:
-                names_list.append(playlist.name)
-            check_for_excluded(playlists, names_list)
+        # set the items for the playlists specified to export
+        for playlist in self.export:
+            playlist.set_items()
 
-    def get_num_playlist_ancestors(self, Playlist):
-        """Determines the Playlist's place in the directory structure"""
+    def get_selection(self, playlists, export_all, subtrees = (), select = (), exclude = (),
+                      interactive = True):
+        """Returns the list of playlists to export, asking the user if none are specified
 
-        num_ancestors = 0
-        current_ancestor = Playlist
+        Playlists are given by exact name, folders whose subtree is exported by
+        exact name, and select and exclude take the patterns of Playlist_Selector.
+        Unless interactive, ValueError is raised instead of asking the user.
+        """
 
-        # while the current ancestor has a parent
-        while current_ancestor.parent_ID is not None:
+        # get the playlists if necessary
+        if not hasattr(self, "playlists"):
+            self.get_playlists()
 
-            # find the current ancestor's parent by looping through the array
-            check_num = 0
-            check = self.playlists[check_num]
+        selector = Playlist_Selector(select, exclude, export_all, playlists, subtrees)
 
-            while not check.persistent_ID == current_ancestor.parent_ID:
-                check_num += 1
-                check = self.playlists[check_num]
+        # ask the user to select the playlists to export if none are specified
+        if selector.is_empty():
+            if not interactive:
+                raise ValueError("no playlists to export were given")
+            chosen = self.select_playlists()
+            selector = Playlist_Selector(["id:" + playlist.persistent_ID for playlist in chosen],
+                                         exclude)
 
-            # set the current ancestor's parent as the new current ancestor
-            current_ancestor = check
-            num_ancestors += 1
+        return selector.select(self.playlists)
 
-        return num_ancestors
+    def get_num_playlist_ancestors(self, Playlist):
+        """Determines the Playlist's place in the directory structure"""
+
+        # the depths are set once along with the playlists
+        if not hasattr(self, "playlists"):
+            self.get_playlists()
+        return Playlist.depth
 
     def select_playlists(self):
-        """Prints the playlists in the library indented by their folder levels"""
+        """Prints the playlists in the library indented by their folder levels and asks for
+        the numbers or patterns of those to export"""
 
         # get the playlists
         if not hasattr(self, "playlists"):
             self.get_playlists()
 
         print("You have not specified any playlists to export! " +
-              "The playlists available will now be printed, " +
-              "please enter y to export the playlist or n to skip it.")
+              "The playlists available will now be printed.")
 
-        chosen = []
-        satisfied = False
+        # print the playlists once, numbered
         tab = " " * TAB_SIZE
-        
-        # loop through the playlists and print them appropriately
-        while not satisfied:
-            for playlist in self.playlists:
-
-                # determine its indentation level
-                indents = self.get_num_playlist_ancestors(playlist)
-                tab_string  = tab * indents
-
-                # determine the type of Playlist
-                type_string = ""
-                if playlist.is_smart:
-                    type_string += "Smart "
-                if playlist.is_folder:
-                    type_string += "Folder"
-                else:
-                    type_string += "Playlist"
-
-
-                input_start = tab_string + playlist.name
-                input_end = " <" + type_string + "> [y/n]? "
-                filler_string = " " * (TABLE_WIDTH - len(input_start) - len(input_end))
-
-                # print the Playlist
-                export = input(input_start + filler_string + input_end)
-
-                # determine whether to export the playlist
-                if export == "y":
-                    chosen.append(playlist)
-
-            # run the playlist chooser until the user is satisfied with their selection
-            chosen_string = (''.join(str(choice.name) + ", " for choice in chosen)).rstrip(", ")
+        width = len(str(len(self.playlists)))
+        for number, playlist in enumerate(self.playlists, 1):
+
+            # determine the type of Playlist
+            type_string = ""
+            if playlist.is_smart:
+                type_string += "Smart "
+            if playlist.is_folder:
+                type_string += "Folder"
+            else:
+                type_string += "Playlist"
+
+            start = str(number).rjust(width) + " " + tab * playlist.depth + playlist.name
+            end = " <" + type_string + ">"
+            print(start + " " * max(TABLE_WIDTH - len(start) - len(end), 1) + end)
+
+        # run the playlist chooser until the user is satisfied with their selection
+        while True:
+            answer = input("Enter the numbers of the playlists to export, such as 1 4-6, " +
+                           "or patterns such as \"Rock*\" or tree:\"Folder\": ")
+            chosen = self.get_choice(answer)
+            chosen_string = ", ".join(choice.name for choice in chosen)
             report = input('Playlists to be exported are: ' + chosen_string + '\n' +
                            'To continue, type "y", to choose a new ' +
                            'set of playlists, type "n" ')
             if not report == "n":
-                satisfied = True
+                return chosen
+
+    def get_choice(self, answer):
+        """Returns the playlists chosen by an answer of numbers, ranges and patterns"""
+
+        import shlex
+        try:
+            words = shlex.split(answer)
+        except ValueError:
+            words = answer.split()
+
+        chosen = set()
+        patterns = []
+        for word in words:
+            first, dash, last = word.partition("-")
+            if first.isdigit() and (not dash or last.isdigit()):
+                for number in range(int(first), int(last or first) + 1):
+                    if 1 <= number <= len(self.playlists):
+                        chosen.add(self.playlists[number - 1].persistent_ID)
+            else:
+                patterns.append(word)
 
-        return chosen
+        if patterns:
+            try:
+                selector = Playlist_Selector(patterns)
+            except ValueError as error:
+                sys.stderr.write(str(error) + "!\n")
+            else:
+                chosen.update(playlist.persistent_ID for playlist in selector.select(self.playlists))
+        return [playlist for playlist in self.playlists if playlist.persistent_ID in chosen]
                 
 
 class Playlist_Writer():
-    """Writes playlists to disk"""
+    """Writes playlists to disk
+
+    Each format is a subclass setting the extension and encoding of its files,
+    which registers it in WRITERS under its extension. The file is rendered by
+    render_chunks, a generator of the chunks of text of the file that is fed
+    the tracks of the playlist one at a time.
+    """
+
+    extension = None # extension of the files written, including the dot
+    encoding = "utf-8" # encoding of the files written
+    errors = "strict" # how characters the encoding can't represent are handled
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.extension is not None:
+            WRITERS[cls.extension[1:].lower()] = cls
 
-    def __init__(self, playlist, root, extension):
+    def __init__(self, playlist, root):
 
         self.playlist = playlist
         self.root = root
-        self.extension = extension
-        self.location = normalize_path(os.path.join(root, self.playlist.name + extension))
+        self.location = normalize_path(os.path.join(root, get_file_name(self.playlist.name) +
+                                                    self.extension))
+        self.skip = False
+        self.media = None
+
+    def get_location(self, item):
+        """Returns the location written for an item, relative to the copy of its audio if any"""
+
+        if self.media is None:
+            return item.location
+        return self.media.get_relative(item.location, self.root)
+
+    def playlist_exists(self, listing = None):
+        """Tests whether the file to write to already exists, using the listing if given"""
+
+        if listing is not None:
+            return listing.contains(self.location)
+        return os.path.exists(self.location)
+
+    def render(self):
+        """Returns the contents of the playlist file"""
+        return render_playlist(self.playlist, [self])[0]
+
+    def render_chunks(self, items, aggregates):
+        """Yields the contents of the playlist file a piece at a time"""
+
+        yield self.render_header(aggregates)
+        for item in items:
+            yield self.render_item(item)
+        yield self.render_footer()
+
+    def render_header(self, aggregates):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def render_item(self, item):
+        raise NotImplementedError("Subclass must implement abstract method")
 
-    def playlist_exists(self):
-        """Tests whether the file to write to already exists"""
+    def render_footer(self):
+        """Returns the end of the playlist file, after the last item"""
+        return ""
 
-        # try to open file to read it
+    def write_file(self, contents = None, fsync = False):
+        """Writes the playlist file, rendering it unless its contents are given"""
+
+        if contents is None:
+            contents = self.render()
+        self.write_bytes(contents.encode(self.encoding, self.errors), fsync)
+
+    def write_bytes(self, encoded, fsync = False, pending = None):
+        """Replaces the playlist file with the encoded contents in one step
+
+        The contents go to a temporary file in the same directory that is then
+        renamed over the playlist file, so readers never see a partial playlist.
+        When pending is given, the rename is left to whoever owns it, see replace_file.
+        """
+
+        file = self.open_temp()
         try:
-            file = open(self.location, 'r')
+            file.write(encoded)
+        except BaseException:
+            self.discard_temp(file)
+            raise
+        self.replace_file(file, fsync, pending)
 
-        # if it fails, then the file doesn't exist
-        except IOError:
-            return False
+    def open_temp(self):
+        """Opens the temporary file the playlist is written to before it replaces the file"""
+
+        if DEBUG:
+            print("Writing file for " + self.playlist.name)
+        return open(self.location + ".tmp", 'wb')
+
+    def replace_file(self, file, fsync = False, pending = None):
+        """Closes the temporary file and renames it over the playlist file
+
+        When pending is given, the temporary file and the playlist file are
+        added to it instead, so that they are flushed and renamed later.
+        """
+
+        try:
+            try:
+                if fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            finally:
+                file.close()
+            if pending is not None:
+                pending.append((file.name, self.location))
+                return
+            os.replace(file.name, self.location)
+        except BaseException:
+            self.discard_temp(file)
+            raise
+
+    def discard_temp(self, file):
+        """Closes and deletes the temporary file, leaving the playlist file as it was"""
 
         file.close()
-        return True
+        if os.path.exists(file.name):
+            os.remove(file.name)
 
-    def write_file(self):
-        raise NotImplementedError("Subclass must implement abstract method")
+    def change_location(self, claimed = (), listing = None, on_conflict = "ask"):
+        """Determines location based on whether the existing playlist should be overwritten
 
-    def change_location(self):
-        """Determines location based on whether the user wishes to overwrite existing playlist"""
+        Locations in claimed were given to other playlists earlier in this run and
+        are never overwritten. When a file not written by this run is in the way,
+        on_conflict chooses to ask the user, overwrite it, rename the playlist or
+        skip it, in which case skip is set.
+        """
 
         # variables for the loop
         first = True
         counter = 2
 
-        name = self.playlist.name + self.extension
+        name = get_file_name(self.playlist.name) + self.extension
         # change the name of the playlist while the location is occupied
-        while self.playlist_exists():
-            if first == True:
-                overwrite = input("File " + name + " exists. Overwrite? [y/n] ")
-                first = False
+        while self.location in claimed or self.playlist_exists(listing):
+            if first == True and self.location not in claimed:
+                if on_conflict == "ask":
+                    overwrite = input("File " + name + " exists. Overwrite? [y/n] ")
+                else:
+                    overwrite = "y" if on_conflict == "overwrite" else "n"
 
                 # if the user chooses not to overwrite, exit the loop
                 if overwrite == "y":
                     print("Will overwrite " + name)
                     break
+                elif on_conflict == "skip":
+                    print("Skipping " + name + ", the file exists")
+                    self.skip = True
+                    break
                 else:
                     print("Creating new name for \"" + name + "\"")
+            first = False
 
             # give the playlist a new name
-            new_name = self.playlist.name + " (" + str(counter) + ")" + self.extension
+            new_name = (get_file_name(self.playlist.name) + " (" + str(counter) + ")" +
+                        self.extension)
             
             self.location = normalize_path(os.path.join(self.root, new_name))
             counter += 1
@@ -439,94 +1360,1219 @@ class Playlist_Writer():
 class WPL_Writer(Playlist_Writer):
     """Writes WPL playlists to disk"""
 
-    def __init__(self, playlist, root):
-        super().__init__(playlist, root, ".wpl")
+    extension = ".wpl"
 
-    def write_file(self):
-        """Writes the playlist file"""
+    def render_header(self, aggregates):
+        """Returns the start of the playlist file, up to the first item"""
 
-        if DEBUG:
-            print("Writing file for " + self.playlist.name)
-        
-        # open the file as utf8
-        file = codecs.open(self.location, 'w', "utf-8")
+        import getpass
 
         # HEADER
         # write initial data
-        file.write(r'<?wpl version = "1.0"?>')
-        file.write("\n" + r"<smil>")
-        file.write("\n" + "\t" + r"<head>")
+        contents = [r'<?wpl version = "1.0"?>']
+        contents.append("\n" + r"<smil>")
+        contents.append("\n" + "\t" + r"<head>")
 
         # write meta data
-        file.write("\n" + "\t" + "\t" +
-                   r"""<meta name = "Generator" content = "Kar's iTunes Export Python Script"/>""")
-        file.write("\n" + "\t" + "\t" + r'<meta name = "TotalDuration" content = ' + "\""
-                   + str(self.playlist.get_total_length()) + r'"/>')
-        file.write("\n" + "\t" + "\t" + r'<meta name = "ItemCount" content = ' + "\""
-                   + str(len(self.playlist.items)) + r'"/>')
-        file.write("\n" + "\t" + "\t" + r"<author>" + getpass.getuser() + r"</author>")
-        file.write("\n" + "\t" + "\t" + r"<title>" + self.playlist.name + r"</title>")
-        file.write("\n" + "\t" + r"</head>")
+        contents.append("\n" + "\t" + "\t" +
+                        r"""<meta name = "Generator" content = "Kar's iTunes Export Python Script"/>""")
+        contents.append("\n" + "\t" + "\t" + r'<meta name = "TotalDuration" content = ' + "\""
+                        + str(aggregates['length']) + r'"/>')
+        contents.append("\n" + "\t" + "\t" + r'<meta name = "ItemCount" content = ' + "\""
+                        + str(aggregates['count']) + r'"/>')
+        contents.append("\n" + "\t" + "\t" + r"<author>" + escape_xml(getpass.getuser()) +
+                        r"</author>")
+        contents.append("\n" + "\t" + "\t" + r"<title>" + escape_xml(self.playlist.name) +
+                        r"</title>")
+        contents.append("\n" + "\t" + r"</head>")
 
         # begin writing body
-        file.write("\n" + "\t" + r"<body>")
-        file.write("\n" + "\t" + "\t" + r"<seq>")
+        contents.append("\n" + "\t" + r"<body>")
+        contents.append("\n" + "\t" + "\t" + r"<seq>")
+
+        return "".join(contents)
+
+    def render_item(self, item):
+        """Returns the entry of an item in the playlist file"""
 
-        # BODY
-        for item in self.playlist.items:
-            file.write("\n" + "\t" + "\t" + "\t")
-            clean_loc = self.clean_string(item['location'])
-            file.write(r'<media src = "' + clean_loc + "\"" + r'/>')
+        clean_loc = self.clean_string(self.get_location(item))
+        return "\n" + "\t" + "\t" + "\t" + r'<media src = "' + clean_loc + "\"" + r'/>'
+
+    def render_footer(self):
+        """Returns the end of the playlist file, after the last item"""
 
         # FOOTER
         # finish writing the file
-        file.write("\n" + "\t" + "\t" + r"</seq>")
-        file.write("\n" + "\t" + r"</body>")
-        file.write("\n" + r"</smil>")
-
-        # close the file
-        file.close()
+        return "\n" + "\t" + "\t" + r"</seq>" + "\n" + "\t" + r"</body>" + "\n" + r"</smil>"
 
     def clean_string(self, location):
         """Cleans the location of characters that will break the file"""
-        return location.replace("&", "&amp;")
+        return escape_xml(location)
 
 
 class M3U8_Writer(Playlist_Writer):
     """Writes m3u8 playlist files to disk"""
 
-    def __init__(self, playlist, root):
-        super().__init__(playlist, root, ".m3u8")
+    extension = ".m3u8"
 
-    def write_file(self):
-        """Writes the playlist file"""
+    def render_header(self, aggregates):
+        """Returns the start of the playlist file, up to the first item"""
+        return r'#EXTM3U'
 
-        if DEBUG:
-            print("Writing file for " + self.playlist.name)
+    def render_item(self, item):
+        """Returns the entry of an item in the playlist file"""
 
         sep = os.linesep
+        return (sep + r"#EXTINF:" + str(int(round(item.length, 0))) + "," + item.get_title() +
+                sep + self.get_location(item))
 
-        # open the file as utf8
-        file = codecs.open(self.location, 'w', "utf-8")
 
-        # HEADER
-        file.write(r'#EXTM3U')
+class M3U_Writer(M3U8_Writer):
+    """Writes plain m3u playlist files in Latin-1 for players that don't read UTF-8
 
-        # BODY
-        for item in self.playlist.items:
-            file.write(sep + r"#EXTINF:" + str(int(round(item['length'], 0))) + "," +
-                       item['name'] + " - " + item['artist'])
-            file.write(sep + item['location'])
+    Characters outside of Latin-1 are written as question marks.
+    """
 
-        # close the file
-        file.close()           
-        
+    extension = ".m3u"
+    encoding = "latin-1"
+    errors = "replace"
+
+
+class PLS_Writer(Playlist_Writer):
+    """Writes pls playlist files to disk"""
+
+    extension = ".pls"
+
+    def render_chunks(self, items, aggregates):
+        """Yields the contents of the playlist file a piece at a time, numbering the entries"""
+
+        sep = os.linesep
+        yield r"[playlist]"
+        for number, item in enumerate(items, 1):
+            number = str(number)
+            yield (sep + "File" + number + "=" + self.get_location(item) +
+                   sep + "Title" + number + "=" + item.get_title() +
+                   sep + "Length" + number + "=" + str(int(round(item.length, 0))))
+        yield sep + "NumberOfEntries=" + str(aggregates['count']) + sep + "Version=2" + sep
+
+
+class XSPF_Writer(Playlist_Writer):
+    """Writes XSPF playlist files to disk"""
+
+    extension = ".xspf"
+
+    def render_header(self, aggregates):
+        """Returns the start of the playlist file, up to the first item"""
+
+        return ('<?xml version="1.0" encoding="UTF-8"?>' +
+                "\n" + '<playlist version="1" xmlns="http://xspf.org/ns/0/">' +
+                "\n" + "\t" + "<title>" + escape_xml(self.playlist.name) + "</title>" +
+                "\n" + "\t" + "<trackList>")
+
+    def render_item(self, item):
+        """Returns the entry of an item in the playlist file"""
+
+        contents = ["\n" + "\t" + "\t" + "<track>"]
+        location = self.get_location(item)
+        if location is not None:
+            contents.append("\n" + "\t" + "\t" + "\t" + "<location>" +
+                            escape_xml(get_location_uri(location)) + "</location>")
+        if item.name is not None:
+            contents.append("\n" + "\t" + "\t" + "\t" + "<title>" + escape_xml(item.name) +
+                            "</title>")
+        if item.artist is not None:
+            contents.append("\n" + "\t" + "\t" + "\t" + "<creator>" + escape_xml(item.artist) +
+                            "</creator>")
+        contents.append("\n" + "\t" + "\t" + "\t" + "<duration>" +
+                        str(int(round(item.length * 1000))) + "</duration>")
+        contents.append("\n" + "\t" + "\t" + "</track>")
+        return "".join(contents)
+
+    def render_footer(self):
+        """Returns the end of the playlist file, after the last item"""
+        return "\n" + "\t" + "</trackList>" + "\n" + "</playlist>" + "\n"
+
+
+class JSONL_Writer(Playlist_Writer):
+    """Writes the tracks of playlists as JSON Lines, one object per track"""
+
+    extension = ".jsonl"
+
+    def render_header(self, aggregates):
+        """Returns the start of the playlist file, up to the first item"""
+        return ""
+
+    def render_item(self, item):
+        """Returns the entry of an item in the playlist file"""
+
+        record = {'name' : item.name, 'artist' : item.artist, 'length' : item.length,
+                  'location' : self.get_location(item)}
+        return json.dumps(record, ensure_ascii = False) + "\n"
+
+
+class Playlist_Output():
+    """Encodes the chunks rendered by a writer and hashes them on the way to its file
+
+    Chunks are gathered until they fill RENDER_BUFFER_SIZE and then encoded
+    together. The encoded contents are kept in memory while they are small, so
+    a playlist that didn't change is never written, and once they grow past
+    OUTPUT_SPILL_SIZE they go to the temporary file of the writer instead, so
+    memory stays bounded however long the playlist is. When pending is given,
+    the finished temporary file is added to it rather than renamed.
+    """
+
+    def __init__(self, writer, fsync = False, pending = None):
+
+        self.writer = writer
+        self.fsync = fsync
+        self.pending_files = pending
+        self.encoder = codecs.getincrementalencoder(writer.encoding)(writer.errors)
+        self.hasher = hashlib.sha1()
+        self.chunks = []
+        self.pending = 0
+        self.encoded = []
+        self.size = 0
+        self.file = None
+
+    def write(self, chunk):
+        """Adds a chunk of text to the contents"""
+
+        self.chunks.append(chunk)
+        self.pending += len(chunk)
+        if self.pending >= RENDER_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self, final = False):
+        """Encodes and hashes the chunks gathered, writing them out once the contents are large"""
+
+        data = self.encoder.encode("".join(self.chunks), final)
+        self.chunks = []
+        self.pending = 0
+        self.hasher.update(data)
+        self.size += len(data)
+
+        if self.file is not None:
+            self.file.write(data)
+            return
+
+        self.encoded.append(data)
+        if self.size > OUTPUT_SPILL_SIZE:
+            self.file = self.writer.open_temp()
+            self.file.write(b"".join(self.encoded))
+            self.encoded = []
+
+    def close(self, previous_hash = None, force = False):
+        """Finishes the contents and writes them to the file of the writer if they changed
+
+        Returns the hash of the contents, whether the file was written and the
+        number of bytes written.
+        """
+
+        self.flush(True)
+        digest = self.hasher.hexdigest()
+        unchanged = digest == previous_hash and not force
+
+        if self.file is None:
+            encoded = b"".join(self.encoded)
+            self.encoded = []
+            if unchanged:
+                return digest, False, 0
+            self.writer.write_bytes(encoded, self.fsync, self.pending_files)
+        elif unchanged:
+            self.discard()
+            return digest, False, 0
+        else:
+            file, self.file = self.file, None
+            self.writer.replace_file(file, self.fsync, self.pending_files)
+        return digest, True, self.size
+
+    def discard(self):
+        """Drops the contents, deleting the temporary file if there is one"""
+
+        self.chunks = []
+        self.encoded = []
+        if self.file is not None:
+            file, self.file = self.file, None
+            self.writer.discard_temp(file)
+
+
+class Export_Manifest():
+    """Record of the playlist files written to an export directory
+
+    For every playlist and format the manifest keeps the name of the file that
+    was written and the SHA-1 of its contents. A playlist whose rendered
+    contents match the manifest is skipped without touching its file.
+    """
+
+    def __init__(self, root, prune = False, sync = DEFAULT_SYNC, jobs = 1):
+        self.root = root
+        self.prune = prune
+        self.sync = sync
+        self.jobs = jobs
+
+        # temporary files waiting to be flushed and renamed at once in batch mode
+        self.pending = []
+        self.directories = set()
+        self.location = normalize_path(os.path.join(root, MANIFEST_NAME))
+        self.listing = Directory_Listing()
+        self.entries = {}
+        self.written = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.failed = 0
+        self.failed_IDs = set()
+
+    def __str__(self):
+        return ("Wrote " + str(self.written) + " files, skipped " + str(self.skipped) +
+                " unchanged files, deleted " + str(self.deleted) + " files, failed to write " +
+                str(self.failed) + " files")
+
+    def load(self):
+        """Reads the manifest left in the export directory by the last run, if there is one"""
+
+        try:
+            manifest_file = codecs.open(self.location, 'r', "utf-8")
+        except IOError:
+            return
+
+        try:
+            manifest = json.load(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = manifest['entries']
+        except ValueError as error:
+            sys.stderr.write("Ignoring unreadable export manifest: " + str(error) + "\n")
+        finally:
+            manifest_file.close()
+
+    def save(self):
+        """Puts the files written in place, then writes the manifest to the export directory"""
+
+        self.commit()
+        temp_location = self.location + ".tmp"
+        manifest_file = codecs.open(temp_location, 'w', "utf-8")
+        json.dump({'version' : MANIFEST_VERSION, 'entries' : self.entries}, manifest_file,
+                  indent = TAB_SIZE, sort_keys = True)
+        manifest_file.close()
+        if self.sync != "none":
+            sync_file(temp_location)
+        os.replace(temp_location, self.location)
+        if self.sync != "none":
+            sync_directory(os.path.dirname(self.location))
+
+    def commit(self):
+        """Flushes the files written to disk, renames them into place and flushes their directories
+
+        In batch mode, rather than waiting for each file to reach the disk as it
+        is written, the temporary files of the whole export are flushed together
+        and only then renamed over the playlist files, so a crash never leaves a
+        partial playlist under its name. Each file system holding them is flushed
+        with a single syncfs where the system has it, otherwise the files are
+        flushed on a pool of threads. The directories holding the renamed files
+        are then flushed once each.
+        """
+
+        pending, self.pending = self.pending, []
+        try:
+            self.sync_pending(pending)
+            while pending:
+                temp_location, location = pending[0]
+                os.replace(temp_location, location)
+                del pending[0]
+        finally:
+            discard_files(temp_location for temp_location, location in pending)
+
+        if self.sync != "none":
+            for directory in sorted(self.directories):
+                sync_directory(directory)
+        self.directories = set()
+
+    def sync_pending(self, pending):
+        """Flushes the pending temporary files to disk, a file system at a time where possible"""
+
+        if not pending:
+            return
+
+        # group the files by file system, through the directories holding them
+        devices = {}
+        for directory in set(os.path.dirname(temp_location) for temp_location, location
+                             in pending):
+            devices.setdefault(os.stat(directory).st_dev, []).append(directory)
+        unsynced = set()
+        for directories in devices.values():
+            if not sync_file_system(directories[0]):
+                unsynced.update(directories)
+
+        # without syncfs, flush each file, in parallel since the waits are on the disk
+        locations = [temp_location for temp_location, location in pending
+                     if os.path.dirname(temp_location) in unsynced]
+        if len(locations) > 1 and self.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers = self.jobs) as executor:
+                list(executor.map(sync_file, locations))
+        else:
+            for location in locations:
+                sync_file(location)
+
+    def discard(self):
+        """Deletes the temporary files not renamed into place yet, leaving the playlist files as they were"""
+
+        pending, self.pending = self.pending, []
+        discard_files(temp_location for temp_location, location in pending)
+
+    def get_location(self, entry):
+        """Returns the location of the file recorded in an entry"""
+        return normalize_path(os.path.join(self.root, entry['file']))
+
+    def plan(self, writer, claimed = (), on_conflict = "ask"):
+        """Chooses the location of a writer, returning the hash recorded for the file there
+
+        A file written by an earlier run for a playlist of the same name in the
+        same directory is reused, otherwise the playlist is new or was renamed and gets a location
+        that is not in claimed. None is returned unless the file is reused.
+        """
+
+        entry = self.entries.get(self.get_key(writer))
+        if entry is not None and entry['name'] == writer.playlist.name and \
+           os.path.dirname(self.get_location(entry)) == os.path.dirname(writer.location) and \
+           self.get_location(entry) not in claimed and \
+           self.listing.contains(self.get_location(entry)):
+            writer.location = self.get_location(entry)
+            return entry['hash']
+
+        # the old file of a renamed playlist is stale
+        if entry is not None:
+            self.delete(entry)
+        writer.change_location(claimed, self.listing, on_conflict)
+        return None
+
+    def write(self, writer, contents, previous_hash = None, force = False):
+        """Writes the rendered contents of a writer to its file if they changed
+
+        Returns the hash of the contents, whether the file was written and the
+        number of bytes written.
+        """
+        return self.write_chunks(writer, [contents], previous_hash, force)
+
+    def write_chunks(self, writer, chunks, previous_hash = None, force = False):
+        """Writes the chunks rendered by a writer to its file if they changed, see write"""
+
+        output = Playlist_Output(writer, self.sync == "file",
+                                 self.pending if self.sync == "batch" else None)
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+            return output.close(previous_hash, force)
+        except BaseException:
+            output.discard()
+            raise
+
+    def record(self, writer, digest, written):
+        """Records the file of a writer and the hash of its contents"""
+
+        self.entries[self.get_key(writer)] = {'id' : writer.playlist.persistent_ID,
+                                              'name' : writer.playlist.name,
+                                              'file' : os.path.relpath(writer.location,
+                                                                       self.root),
+                                              'hash' : digest}
+        if written:
+            self.written += 1
+            self.directories.add(os.path.dirname(writer.location))
+        else:
+            self.skipped += 1
+
+    def fail(self, writer):
+        """Counts a file that could not be written, remembering its playlist"""
+
+        self.failed += 1
+        self.failed_IDs.add(writer.playlist.persistent_ID)
+
+    def get_key(self, writer):
+        """Returns the key of the entry for the playlist and format of a writer"""
+        return writer.playlist.persistent_ID + writer.extension
+
+    def delete(self, entry):
+        """When pruning, deletes the file of an entry if it still holds what was written"""
+
+        location = self.get_location(entry)
+        if self.prune and self.listing.contains(location) and \
+           hash_file(location) == entry['hash']:
+            if DEBUG:
+                print("Deleting " + location)
+            os.remove(location)
+            self.listing.discard(location)
+            self.deleted += 1
+
+    def prune_playlists(self, persistent_IDs):
+        """Forgets the entries of playlists not in the given IDs, deleting their files"""
+
+        for key, entry in list(self.entries.items()):
+            if entry['id'] not in persistent_IDs:
+                self.delete(entry)
+                del self.entries[key]
         
 
+class Directory_Listing():
+    """Names of the files in the export directories, each listed once with a single scan
+
+    Looking names up in the listing replaces opening every candidate file, which
+    is slow on network shares. Names are compared the way the system does.
+    """
+
+    def __init__(self):
+        self.directories = {}
+
+    def get_names(self, directory):
+        """Returns the set of names in a directory, scanning it the first time"""
+
+        names = self.directories.get(directory)
+        if names is None:
+            names = self.directories[directory] = set()
+            try:
+                for entry in os.scandir(directory):
+                    names.add(os.path.normcase(entry.name))
+            except OSError:
+                pass
+        return names
+
+    def contains(self, location):
+        """Tests whether there is a file or directory at the location"""
+
+        directory, name = os.path.split(location)
+        return os.path.normcase(name) in self.get_names(directory)
+
+    def discard(self, location):
+        """Forgets a file that was deleted"""
+
+        directory, name = os.path.split(location)
+        self.get_names(directory).discard(os.path.normcase(name))
+
+
+class Media_Sync():
+    """Copies or hard links the audio of playlists into the export directory
+
+    Each file is put in the media directory at its path inside the Music Folder
+    of the library, or under MEDIA_EXTERNAL_DIR when it is outside of it, so it
+    keeps the same place from one run to the next. Files already there with
+    the same size and modification time are skipped, and copies are made under
+    a temporary name and renamed once complete, so an interrupted sync resumes
+    with the files it didn't finish.
+    """
+
+    def __init__(self, root, music_folder = None, mode = "copy", jobs = DEFAULT_MEDIA_JOBS):
+        self.root = root
+        self.music_folder = music_folder
+        self.mode = mode
+        self.jobs = jobs
+        self.synced = {}
+        self.relatives = {}
+        self.counts = {'copied' : 0, 'linked' : 0, 'skipped' : 0, 'failed' : 0}
+        self.bytes_copied = 0
+
+    def __str__(self):
+        return ("Copied " + str(self.counts['copied']) + " audio files (" +
+                str(self.bytes_copied // (1 << 20)) + " MB), linked " +
+                str(self.counts['linked']) + ", skipped " + str(self.counts['skipped']) +
+                " up to date files, failed to sync " + str(self.counts['failed']) + " files")
+
+    def get_destination(self, location):
+        """Returns the location of the copy of the audio file at a location"""
+
+        path = location.replace("\\", "/")
+        music_folder = None
+        if self.music_folder is not None:
+            music_folder = self.music_folder.replace("\\", "/").rstrip("/") + "/"
+        if music_folder is not None and path.startswith(music_folder):
+            parts = path[len(music_folder):].split("/")
+        else:
+            # keep the drive of files outside of the Music Folder as a directory
+            parts = [MEDIA_EXTERNAL_DIR] + path.replace(":", "").split("/")
+        return normalize_path(os.path.join(self.root, *[part for part in parts if part]))
+
+    def get_relative(self, location, root):
+        """Returns the location of the copy of an audio file relative to a directory, or the
+        location itself if it wasn't synced"""
+
+        destination = self.synced.get(location)
+        if destination is None:
+            return location
+        relative = self.relatives.get((destination, root))
+        if relative is None:
+            relative = self.relatives[(destination, root)] = os.path.relpath(destination, root)
+        return relative
+
+    def sync(self, locations):
+        """Copies or links the audio files at the given locations, each one once"""
+
+        locations = set(location for location in locations if location is not None)
+        destinations = dict((location, self.get_destination(location))
+                            for location in locations)
+
+        # create every directory up front so the workers never race to create one
+        for directory in set(os.path.dirname(destination)
+                             for destination in destinations.values()):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers = self.jobs)
+        pairs = sorted(destinations.items())
+        results = executor.map(self.sync_file, pairs)
+        for (location, destination), (outcome, size) in zip(pairs, results):
+            self.counts[outcome] += 1
+            self.bytes_copied += size
+            if not outcome == "failed":
+                self.synced[location] = destination
+        executor.shutdown()
+
+    def sync_file(self, pair):
+        """Copies or links one audio file, returning what was done and the bytes copied"""
+
+        location, destination = pair
+        try:
+            source_stat = os.stat(location)
+        except OSError as error:
+            sys.stderr.write("Could not sync " + location + ": " + str(error) + "!\n")
+            return "failed", 0
+
+        # leave files that are already there alone
+        try:
+            destination_stat = os.stat(destination)
+        except OSError:
+            destination_stat = None
+        if destination_stat is not None:
+            if self.mode == "link" and os.path.samestat(source_stat, destination_stat):
+                return "skipped", 0
+            if self.mode == "copy" and destination_stat.st_size == source_stat.st_size and \
+               abs(destination_stat.st_mtime - source_stat.st_mtime) <= MEDIA_MTIME_TOLERANCE:
+                return "skipped", 0
+
+        try:
+            if self.mode == "link":
+                try:
+                    temp_location = destination + ".link"
+                    if os.path.lexists(temp_location):
+                        os.remove(temp_location)
+                    os.link(location, temp_location)
+                    os.replace(temp_location, destination)
+                    return "linked", 0
+                except OSError as error:
+                    # files on another device or file system can only be copied
+                    if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                           errno.ENOTSUP):
+                        raise
+            self.copy_file(location, destination, source_stat)
+        except OSError as error:
+            sys.stderr.write("Could not sync " + location + ": " + str(error) + "!\n")
+            return "failed", 0
+        return "copied", source_stat.st_size
+
+    def copy_file(self, location, destination, source_stat):
+        """Copies a file under a temporary name, then renames it into place"""
+
+        temp_location = destination + ".part"
+        source_file = open(location, 'rb')
+        try:
+            destination_file = open(temp_location, 'wb')
+            try:
+                copy_file_data(source_file, destination_file, source_stat.st_size)
+            finally:
+                destination_file.close()
+        finally:
+            source_file.close()
+
+        # copy the modification time so the next run sees the copy is up to date
+        os.utime(temp_location, ns = (source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(temp_location, destination)
+
+
+class File_Verifier():
+    """Checks that the files of tracks exist, remembering the results between runs
+
+    A file is only added to or removed from a directory by changing the
+    modification time of the directory, so the results for the files of a
+    directory are kept as long as its modification time stays the same. Only
+    the directories are checked again on later runs, which saves most of the
+    checks on slow network shares.
+    """
+
+    def __init__(self, location, jobs = DEFAULT_VERIFY_JOBS):
+        self.location = location
+        self.jobs = jobs
+        self.directories = {}
+        self.checked = 0
+
+    def load(self):
+        """Reads the results of the last run, if there are any"""
+
+        try:
+            cache_file = codecs.open(self.location, 'r', "utf-8")
+        except IOError:
+            return
+
+        try:
+            cache = json.load(cache_file)
+            if cache.get('version') == FILE_CACHE_VERSION:
+                self.directories = cache['directories']
+        except ValueError as error:
+            sys.stderr.write("Ignoring unreadable file cache: " + str(error) + "\n")
+        finally:
+            cache_file.close()
+
+    def save(self):
+        """Writes the results to the cache file"""
+
+        temp_location = self.location + ".tmp"
+        try:
+            cache_file = codecs.open(temp_location, 'w', "utf-8")
+            json.dump({'version' : FILE_CACHE_VERSION, 'directories' : self.directories},
+                      cache_file)
+            cache_file.close()
+            os.replace(temp_location, self.location)
+        except (IOError, OSError) as error:
+            sys.stderr.write("Could not save file cache: " + str(error) + "\n")
+
+    def get_mtime(self, directory):
+        """Returns the modification time of a directory, or None if it doesn't exist"""
+
+        try:
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def verify(self, locations):
+        """Returns the set of the given locations whose files don't exist"""
+
+        # group the files by directory, each location is checked once
+        by_directory = {}
+        for location in set(locations):
+            directory, name = os.path.split(location)
+            by_directory.setdefault(directory, []).append((name, location))
+
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers = self.jobs)
+        directories = list(by_directory)
+        mtimes = executor.map(self.get_mtime, directories)
+
+        # use the results of directories that haven't changed
+        missing = set()
+        unknown = []
+        for directory, mtime in zip(directories, mtimes):
+            if mtime is None:
+                self.directories.pop(directory, None)
+                missing.update(location for name, location in by_directory[directory])
+                continue
+            entry = self.directories.get(directory)
+            if entry is None or entry['mtime'] != mtime:
+                entry = self.directories[directory] = {'mtime' : mtime, 'files' : {}}
+            for name, location in by_directory[directory]:
+                exists = entry['files'].get(name)
+                if exists is None:
+                    unknown.append((entry, name, location))
+                elif not exists:
+                    missing.add(location)
+
+        # check the rest of the files in parallel
+        results = executor.map(os.path.isfile, [location for entry, name, location in unknown])
+        for (entry, name, location), exists in zip(unknown, results):
+            entry['files'][name] = exists
+            if not exists:
+                missing.add(location)
+        executor.shutdown()
+        self.checked = len(unknown)
+
+        return missing
+
+
+class Library_Watcher():
+    """Polls the library file and waits for iTunes to finish rewriting it"""
+
+    def __init__(self, location, interval = WATCH_INTERVAL, settle = WATCH_SETTLE):
+        self.location = location
+        self.interval = interval
+        self.settle = settle
+        self.state = self.get_state()
+
+    def get_state(self):
+        """Returns the size and modification time of the library, or None if it is missing"""
+
+        try:
+            stat = os.stat(self.location)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def wait_for_change(self):
+        """Blocks until the library has changed and stayed unchanged for the settle time"""
+
+        while True:
+            time.sleep(self.interval)
+            state = self.get_state()
+            if state is None or state == self.state:
+                continue
+
+            # iTunes rewrites the library in several steps, wait until it is done
+            while True:
+                time.sleep(self.settle)
+                settled = self.get_state()
+                if settled == state:
+                    break
+                state = settled
+            if state is not None and state != self.state:
+                self.state = state
+                return state
+
+
+class Batch_Job():
+    """A library exported in batch mode with the settings of its section of the manifest"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.stats = Export_Stats()
+        self.error = None
+        self.seconds = 0
+
+    def run(self, document, seconds_parse):
+        """Selects and writes the playlists of the library parsed in a worker process"""
+
+        start = time.perf_counter()
+        self.stats.add_phase("parse", seconds_parse)
+        try:
+            for path in (self.args.library, self.args.export_dir):
+                if not os.path.exists(path):
+                    raise IOError(path + " does not exist")
+            playlists_location = self.args.playlists_file if self.args.file else None
+            playlist_names = read_playlist_names(self.args, playlists_location)
+            export_library(self.args, self.args.library, self.args.export_dir, playlist_names,
+                           None, self.stats, document = document)
+        except Exception as error:
+            self.fail(error)
+        self.seconds = seconds_parse + time.perf_counter() - start
+
+    def fail(self, error):
+        """Records the error that stopped the job"""
+
+        self.error = error
+        sys.stderr.write("Job " + self.name + " failed: " + type(error).__name__ + ": " +
+                         str(error) + "!\n")
+
+    def get_summary(self):
+        """Returns a line describing the outcome and throughput of the job"""
+
+        counters = self.stats.counters
+        items = counters.get("items", 0)
+        summary = (self.name + ": " + str(len(self.stats.playlists)) + " playlists, " +
+                   str(items) + " items, " + str(counters.get("files_written", 0)) +
+                   " files written, " + str(counters.get("files_failed", 0)) + " failed in " +
+                   "%.3f" % self.seconds + " s")
+        if self.seconds > 0:
+            summary += " (" + "%.0f" % (items / self.seconds) + " items/s)"
+        if self.error is not None:
+            summary += ", FAILED: " + str(self.error)
+        return summary
+
+    def get_record(self):
+        """Returns the outcome, timings and counters of the job for the stats JSON"""
+
+        return {'name' : self.name, 'library' : self.args.library,
+                'export_dir' : self.args.export_dir,
+                'error' : None if self.error is None else str(self.error),
+                'seconds' : self.seconds,
+                'phases' : [{'name' : name, 'seconds' : seconds}
+                            for name, seconds in self.stats.phases],
+                'counters' : self.stats.counters, 'playlists' : self.stats.playlists}
+
+
+class Library_Columns():
+    """The tracks and playlists of a whole library held in columns, for library wide statistics
+
+    Each track is a row of columns holding its Track ID, its length in
+    milliseconds, a code for its artist and a code for its title and artist,
+    which duplicate tracks share. The rows of the items of every playlist are
+    held end to end in a single column, with the offset of each playlist. The
+    columns are NumPy arrays when NumPy is installed, and arrays of the array
+    module otherwise, in which case the statistics are computed with batched
+    builtins instead of vectorized operations.
+    """
+
+    def __init__(self, library, use_numpy = True):
+        numpy = None
+        if use_numpy:
+            try:
+                import numpy
+            except ImportError:
+                numpy = None
+        self.numpy = numpy
+        self.memberships = None
+
+        # read the fields of every track, giving each artist and title a code
+        parser = library.parser
+        get_value = parser.get_key_value
+        ids = array('q')
+        milliseconds = array('q')
+        artists = array('l')
+        titles = array('l')
+        artist_codes = {}
+        title_codes = {}
+        self.artist_names = []
+        self.title_names = []
+        for track_dict in parser.get_track_dicts():
+            ids.append(parser.get_track_id(track_dict))
+            milliseconds.append(int(get_value(track_dict, "Total Time") or 0))
+            artist = get_value(track_dict, "Artist") or ""
+            artist_code = artist_codes.get(artist)
+            if artist_code is None:
+                artist_code = artist_codes[artist] = len(self.artist_names)
+                self.artist_names.append(artist)
+            artists.append(artist_code)
+            name = get_value(track_dict, "Name") or ""
+            title = (name.casefold(), artist_code)
+            title_code = title_codes.get(title)
+            if title_code is None:
+                title_code = title_codes[title] = len(self.title_names)
+                self.title_names.append((name, artist))
+            titles.append(title_code)
+
+        # put the Track IDs of every playlist end to end
+        self.playlists = library.playlists
+        items = array('q')
+        offsets = array('q', [0])
+        for playlist in self.playlists:
+            items.extend(playlist.parser.get_track_ids())
+            offsets.append(len(items))
+
+        # playlists built into iTunes and folders hold tracks of other playlists, so
+        # they are left out when comparing playlists
+        self.compared = array('b', [not (playlist.is_folder or
+                                         parser.get_key_bool_value(playlist.parser.node,
+                                                                   "Master") or
+                                         parser.get_key_value(playlist.parser.node,
+                                                              "Distinguished Kind") is not None)
+                                    for playlist in self.playlists])
+
+        if numpy is not None:
+            self.ids = numpy.frombuffer(ids, dtype = numpy.int64)
+            self.milliseconds = numpy.frombuffer(milliseconds, dtype = numpy.int64)
+            self.artists = numpy.array(artists, dtype = numpy.int64)
+            self.titles = numpy.array(titles, dtype = numpy.int64)
+            self.compared = numpy.array(self.compared, dtype = bool)
+
+            # look up the row of every item at once, dropping the missing tracks
+            items = numpy.frombuffer(items, dtype = numpy.int64)
+            offsets = numpy.frombuffer(offsets, dtype = numpy.int64)
+            order = numpy.argsort(self.ids, kind = "stable")
+            if len(order):
+                sorted_ids = self.ids[order]
+                positions = numpy.minimum(numpy.searchsorted(sorted_ids, items), len(order) - 1)
+                found = sorted_ids[positions] == items
+                self.rows = order[positions][found]
+            else:
+                found = numpy.zeros(len(items), dtype = bool)
+                self.rows = order
+            kept = numpy.concatenate(([0], numpy.cumsum(found)))
+            self.offsets = kept[offsets]
+            self.missing = int(len(items) - len(self.rows))
+        else:
+            self.ids = ids
+            self.milliseconds = milliseconds
+            self.artists = artists
+            self.titles = titles
+            row_of = dict((track_id, row) for row, track_id in enumerate(ids))
+            self.rows = array('q')
+            self.offsets = array('q', [0])
+            for start, end in zip(offsets, offsets[1:]):
+                self.rows.extend(row for row in map(row_of.get, items[start:end])
+                                 if row is not None)
+                self.offsets.append(len(self.rows))
+            self.missing = len(items) - len(self.rows)
+
+    def get_distinct(self, values, counts = False):
+        """Returns the distinct values of a NumPy array in order, and how many times each
+        appears if counts is set, sorting instead of hashing as it is faster for integers"""
+
+        numpy = self.numpy
+        values = numpy.sort(values)
+        starts = numpy.flatnonzero(numpy.concatenate(([True], values[1:] != values[:-1])))
+        if not len(values):
+            starts = starts[:0]
+        if counts:
+            return values[starts], numpy.diff(numpy.append(starts, len(values)))
+        return values[starts]
+
+    def get_playlist_of_items(self):
+        """Returns the index of the playlist of every item, NumPy only"""
+
+        numpy = self.numpy
+        return numpy.repeat(numpy.arange(len(self.playlists)), numpy.diff(self.offsets))
+
+    def get_memberships(self):
+        """Returns the distinct (row, playlist) pairs of the compared playlists, sorted by row"""
+
+        if self.memberships is not None:
+            return self.memberships
+
+        numpy = self.numpy
+        count = len(self.playlists)
+        if numpy is not None:
+            playlists = self.get_playlist_of_items()
+            compared = self.compared[playlists]
+            codes = self.get_distinct(self.rows[compared] * count + playlists[compared])
+            self.memberships = codes // count, codes % count
+            return self.memberships
+
+        pairs = set()
+        for index, (start, end) in enumerate(zip(self.offsets, self.offsets[1:])):
+            if self.compared[index]:
+                pairs.update((row, index) for row in self.rows[start:end])
+        pairs = sorted(pairs)
+        self.memberships = (array('q', [row for row, index in pairs]),
+                            array('q', [index for row, index in pairs]))
+        return self.memberships
+
+    def get_playlist_totals(self):
+        """Returns the number of items, distinct tracks and milliseconds of every playlist"""
+
+        numpy = self.numpy
+        if numpy is not None:
+            counts = numpy.diff(self.offsets)
+            lengths = numpy.concatenate(([0], numpy.cumsum(self.milliseconds[self.rows])))
+            totals = lengths[self.offsets[1:]] - lengths[self.offsets[:-1]]
+            tracks = len(self.ids)
+            codes = self.get_distinct(self.get_playlist_of_items() * tracks + self.rows)
+            distinct = numpy.bincount(codes // max(tracks, 1), minlength = len(self.playlists))
+            return counts.tolist(), distinct.tolist(), totals.tolist()
+
+        counts = []
+        distinct = []
+        totals = []
+        lookup = self.milliseconds.__getitem__
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            rows = self.rows[start:end]
+            counts.append(len(rows))
+            distinct.append(len(set(rows)))
+            totals.append(sum(map(lookup, rows)))
+        return counts, distinct, totals
+
+    def get_artist_totals(self):
+        """Returns the number of tracks, milliseconds and items in the compared playlists of
+        every artist"""
+
+        numpy = self.numpy
+        count = len(self.artist_names)
+        if numpy is not None:
+            tracks = numpy.bincount(self.artists, minlength = count)
+            totals = numpy.bincount(self.artists, weights = self.milliseconds, minlength = count)
+            compared = self.compared[self.get_playlist_of_items()]
+            items = numpy.bincount(self.artists[self.rows[compared]], minlength = count)
+            return tracks.tolist(), [int(total) for total in totals], items.tolist()
+
+        tracks = [0] * count
+        totals = [0] * count
+        items = [0] * count
+        for artist, length in zip(self.artists, self.milliseconds):
+            tracks[artist] += 1
+            totals[artist] += length
+        for index, (start, end) in enumerate(zip(self.offsets, self.offsets[1:])):
+            if self.compared[index]:
+                for row in self.rows[start:end]:
+                    items[self.artists[row]] += 1
+        return tracks, totals, items
+
+    def get_duplicates(self):
+        """Returns the title codes shared by several tracks, with the rows of the tracks of each
+        and the number of compared playlists holding any of them"""
+
+        numpy = self.numpy
+        memberships = self.get_memberships()
+        if numpy is not None:
+            copies = numpy.bincount(self.titles, minlength = len(self.title_names))
+            duplicated = numpy.flatnonzero(copies > 1)
+            order = numpy.argsort(self.titles, kind = "stable")
+            starts = numpy.concatenate(([0], numpy.cumsum(copies)))
+            rows, playlists = memberships
+            codes = self.get_distinct(self.titles[rows] * len(self.playlists) + playlists)
+            holders = numpy.bincount(codes // max(len(self.playlists), 1),
+                                     minlength = len(self.title_names))
+            return [(int(code), order[starts[code]:starts[code + 1]].tolist(), int(holders[code]))
+                    for code in duplicated]
+
+        groups = {}
+        for row, title in enumerate(self.titles):
+            groups.setdefault(title, []).append(row)
+        holders = {}
+        for row, index in zip(*memberships):
+            holders.setdefault(self.titles[row], set()).add(index)
+        return [(title, rows, len(holders.get(title, ()))) for title, rows in groups.items()
+                if len(rows) > 1]
+
+    def get_overlaps(self):
+        """Returns the number of tracks shared by every pair of compared playlists sharing any,
+        keyed by the pair of their indexes"""
+
+        numpy = self.numpy
+        rows, playlists = self.get_memberships()
+        count = len(self.playlists)
+        if numpy is not None:
+            # pair each membership with those of the same track further along
+            pairs = []
+            distance = 1
+            while distance < len(rows):
+                same = rows[:-distance] == rows[distance:]
+                if not same.any():
+                    break
+                pairs.append(playlists[:-distance][same] * count + playlists[distance:][same])
+                distance += 1
+            if not pairs:
+                return {}
+            codes, shared = self.get_distinct(numpy.concatenate(pairs), counts = True)
+            return dict(((int(code) // count, int(code) % count), int(number))
+                        for code, number in zip(codes, shared))
+
+        from itertools import combinations, groupby
+        overlaps = {}
+        position = 0
+        for row, group in groupby(rows):
+            size = len(list(group))
+            if size > 1:
+                for pair in combinations(playlists[position:position + size], 2):
+                    overlaps[pair] = overlaps.get(pair, 0) + 1
+            position += size
+        return overlaps
+
+
+class Export_Stats():
+    """Timings and counters of an export, for the whole run and for each playlist"""
+
+    def __init__(self):
+        self.phases = []
+        self.counters = {}
+        self.playlists = []
+        self.playlist_indexes = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Times the code run inside the with statement as the phase of the given name"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def add_phase(self, name, seconds):
+        """Records a phase timed elsewhere"""
+        self.phases.append((name, seconds))
+
+    def count(self, name, amount = 1):
+        """Adds the amount to the run wide counter of the given name"""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get_playlist_stats(self, playlist):
+        """Returns the counters of a playlist, creating them on first use"""
+
+        index = self.playlist_indexes.get(playlist.persistent_ID)
+        if index is None:
+            index = self.playlist_indexes[playlist.persistent_ID] = len(self.playlists)
+            self.playlists.append({'name' : playlist.name, 'id' : playlist.persistent_ID,
+                                   'items' : 0, 'missing' : 0, 'files_written' : 0,
+                                   'files_skipped' : 0, 'files_failed' : 0,
+                                   'bytes_written' : 0, 'seconds_write' : 0})
+        return self.playlists[index]
+
+    def add_playlist(self, playlist):
+        """Counts the items resolved and the Track IDs missing from a resolved playlist"""
+
+        playlist_stats = self.get_playlist_stats(playlist)
+        playlist_stats['items'] = len(playlist.rows)
+        playlist_stats['missing'] = playlist.missing
+        self.count("items", len(playlist.rows))
+        self.count("missing", playlist.missing)
+
+    def add_file(self, writer, written, size, error = None):
+        """Counts a file written, skipped or failed for the playlist of a writer"""
+
+        if error is not None:
+            outcome = "files_failed"
+        elif written:
+            outcome = "files_written"
+        else:
+            outcome = "files_skipped"
+        playlist_stats = self.get_playlist_stats(writer.playlist)
+        playlist_stats[outcome] += 1
+        playlist_stats['bytes_written'] += size
+        self.count(outcome)
+        self.count("bytes_written", size)
+
+    def add_time(self, playlist, name, seconds):
+        """Adds the seconds spent on a playlist in the phase of the given name"""
+        self.get_playlist_stats(playlist)['seconds_' + name] += seconds
+
+    def print_table(self):
+        """Prints the timings of each phase and the run wide counters"""
+
+        for name, seconds in self.phases:
+            end = "%.3f s" % seconds
+            print(name + " " * max(TABLE_WIDTH - len(name) - len(end), 1) + end)
+        for name in sorted(self.counters):
+            end = str(self.counters[name])
+            print(name + " " * max(TABLE_WIDTH - len(name) - len(end), 1) + end)
+
+    def save(self, location):
+        """Writes the timings and counters of the run and each playlist as JSON"""
+
+        stats_file = codecs.open(location, 'w', "utf-8")
+        json.dump({'phases' : [{'name' : name, 'seconds' : seconds}
+                               for name, seconds in self.phases],
+                   'counters' : self.counters, 'playlists' : self.playlists},
+                  stats_file, indent = TAB_SIZE)
+        stats_file.close()
+
+
+class Null_Stats():
+    """Stand-in for Export_Stats that collects nothing, used when stats are turned off"""
+
+    def phase(self, name):
+        return self
+
+    def add_phase(self, name, seconds):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def count(self, name, amount = 1):
+        pass
+
+    def add_playlist(self, playlist):
+        pass
+
+    def add_file(self, writer, written, size, error = None):
+        pass
+
+    def add_time(self, playlist, name, seconds):
+        pass
+
+
 ##################################################################
 ## FUNCTIONS
 ##################################################################
 
+def decode_plist_value(tag, text):
+    """Returns the Python value of a plist scalar with the given tag and text"""
+
+    if tag == "integer":
+        return int(text)
+    if tag == "real":
+        return float(text)
+    if tag == "true" or tag == "false":
+        return tag == "true"
+    if tag == "date":
+        return datetime.strptime(text, PLIST_DATE_FORMAT)
+    return text
+
 def get_settings_location():
     """Get the playlist info text file from the current directory"""
 
@@ -537,6 +2583,166 @@ def get_settings_location():
     # normalize and return the entire path
     return normalize_path(os.path.join(settings_location, SETTINGS_NAME + ".txt"))
 
+def get_cache_location(job = None):
+    """Get the location of the parsed library cache, kept next to the settings file, with one
+    cache for each job in batch mode"""
+
+    settings_location = os.path.dirname(get_settings_location())
+    return normalize_path(os.path.join(settings_location, get_job_file_name(CACHE_NAME, job) +
+                                       ".pickle"))
+
+def get_file_cache_location(job = None):
+    """Get the location of the cache of the track files found to exist"""
+
+    settings_location = os.path.dirname(get_settings_location())
+    return normalize_path(os.path.join(settings_location,
+                                       get_job_file_name(FILE_CACHE_NAME, job) + ".json"))
+
+def get_job_file_name(name, job = None):
+    """Returns the name of a file kept for the given batch job, or the name itself outside
+    batch mode"""
+
+    if job is None:
+        return name
+    return name + "-" + sub(r"[^\w.-]", "_", job)
+
+def get_config_location():
+    """Get the location of the config file given with --config, in the environment or next to
+    the settings file, and whether it was given"""
+
+    # look for --config ahead of the other arguments, which it supplies defaults for
+    pre_parser = argparse.ArgumentParser(add_help = False)
+    pre_parser.add_argument('--config')
+    config_location = pre_parser.parse_known_args()[0].config
+    if config_location is None:
+        config_location = os.environ.get(ENVIRONMENT_PREFIX + "CONFIG")
+    if config_location is not None:
+        return config_location, True
+
+    settings_location = os.path.dirname(get_settings_location())
+    return normalize_path(os.path.join(settings_location, CONFIG_NAME + ".ini")), False
+
+def get_config_defaults(parser):
+    """Returns the defaults of the command line arguments set in the config file and
+    environment, the environment taking precedence"""
+
+    # read the settings of the config file, then those of the environment
+    settings = []
+    config_location, given = get_config_location()
+    if given or os.path.exists(config_location):
+        from configparser import ConfigParser, Error as ConfigError
+        config = ConfigParser(interpolation = None)
+        try:
+            if not config.read(config_location, encoding = "utf-8"):
+                parser.error("could not read config file " + config_location)
+        except ConfigError as error:
+            parser.error("could not read config file " + config_location + ": " + str(error))
+        if config.has_section(CONFIG_SECTION):
+            for key, value in config.items(CONFIG_SECTION):
+                settings.append((key, value, config_location))
+    for name in sorted(os.environ):
+        if name.startswith(ENVIRONMENT_PREFIX) and not name == ENVIRONMENT_PREFIX + "CONFIG":
+            settings.append((name[len(ENVIRONMENT_PREFIX):], os.environ[name], "environment"))
+
+    return convert_settings(parser, settings)
+
+def convert_settings(parser, settings, ignore = ()):
+    """Returns the values of the command line arguments given by (key, value, source) settings,
+    skipping the settings whose arguments are in ignore"""
+
+    # convert each setting the way its command line argument would be
+    actions = dict((action.dest, action) for action in parser._actions)
+    values = {}
+    for key, value, source in settings:
+        action = actions.get(key.lower().replace("-", "_"))
+        if action is None or action.dest in ("help", "config"):
+            sys.stderr.write("Ignoring unknown setting " + key + " in " + source + "!\n")
+            continue
+        if action.dest in ignore:
+            sys.stderr.write("Ignoring setting " + key + " in " + source +
+                             ", it applies to the whole run!\n")
+            continue
+        values[action.dest] = convert_setting(parser, action, value, key, source)
+    return values
+
+def read_batch_manifest(parser, args):
+    """Returns a Batch_Job for each section of the batch manifest
+
+    Each section names a job and gives the settings of its library like the
+    config file does, with library and export_dir required. Settings not in a
+    section come from the [DEFAULT] section and then from the command line.
+    """
+
+    from configparser import ConfigParser, Error as ConfigError
+    config = ConfigParser(interpolation = None)
+    try:
+        if not config.read(args.batch, encoding = "utf-8"):
+            parser.error("could not read batch manifest " + args.batch)
+    except ConfigError as error:
+        parser.error("could not read batch manifest " + args.batch + ": " + str(error))
+    if not config.sections():
+        parser.error("batch manifest " + args.batch + " has no jobs")
+
+    jobs = []
+    for section in config.sections():
+        source = args.batch + " [" + section + "]"
+        settings = [(key, value, source) for key, value in config.items(section)]
+        job_args = argparse.Namespace(**vars(args))
+        for dest, value in convert_settings(parser, settings, BATCH_SETTINGS).items():
+            setattr(job_args, dest, value)
+
+        # jobs run unattended, so everything they need must be in the manifest
+        if job_args.library is None or job_args.export_dir is None:
+            parser.error(source + " must give the library and export_dir")
+        if job_args.file and job_args.playlists_file is None:
+            parser.error(source + " must give the playlists_file to read with file")
+        if not (job_args.all or job_args.playlists or job_args.file or job_args.subtree or
+                job_args.select):
+            parser.error(source + " must give the playlists to export")
+        if job_args.on_conflict == "ask":
+            parser.error(source + " can't ask about conflicts in batch mode")
+        try:
+            Playlist_Selector(job_args.select, job_args.exclude)
+        except ValueError as error:
+            parser.error(source + ": " + str(error))
+        if job_args.drop_missing:
+            job_args.verify_files = True
+        job_args.job_name = section
+        jobs.append(Batch_Job(section, job_args))
+    return jobs
+
+def convert_setting(parser, action, value, key, source):
+    """Returns the value of a setting from the config file or environment converted for the
+    command line argument it gives the default of"""
+
+    import shlex
+    try:
+        # flags take yes or no, lists are split like a shell, pairs take one per line
+        if action.nargs == 0:
+            flag = value.strip().lower()
+            if flag not in ("1", "yes", "true", "on", "0", "no", "false", "off"):
+                raise ValueError("expected yes or no")
+            return flag in ("1", "yes", "true", "on")
+        if action.nargs in ("*", "+"):
+            values = [(action.type or str)(item) for item in shlex.split(value)]
+        elif action.nargs == 2:
+            values = [shlex.split(line) for line in value.splitlines() if line.strip()]
+            if any(not len(pair) == 2 for pair in values):
+                raise ValueError("expected two values on each line")
+            return values
+        else:
+            values = [(action.type or str)(value.strip())]
+        if action.choices is not None:
+            for item in values:
+                if item not in action.choices:
+                    raise ValueError("expected one of " + ", ".join(action.choices))
+    except ValueError as error:
+        parser.error("invalid value for " + key + " in " + source + ": " + str(error))
+
+    if action.nargs in ("*", "+"):
+        return values
+    return values[0]
+
 def get_settings_lines():
     """Returns a list of the lines in the settings file"""
 
@@ -568,7 +2774,16 @@ def confirm_name(info_lines, line_num, filetypes, title):
     if not os.path.exists(path):
         if DEBUG:
             print("path " + str(path) + " does not exist")
-        Tk().withdraw()
+
+        # only load tkinter once a dialog is needed, it fails without a display
+        try:
+            from tkinter import Tk
+            from tkinter.filedialog import askopenfilename, askdirectory
+            Tk().withdraw()
+        except Exception as error:
+            sys.stderr.write("Could not open a dialog to \"" + title + "\" (" + str(error) +
+                             "), give the path with an option or in the config file!\n")
+            sys.exit(1)
         if directory:
             path = askdirectory(title = title)
         else:
@@ -593,12 +2808,107 @@ def normalize_path(path):
     """Normalize the path by replacing all the slashes with the default system slash"""
 
     # replace forward slashes in Windows and backslashes otherwise
-    if system() == "Windows":
-        return path.replace("/", "\\")
-    else:
-        return path.replace("\\", "/")
+    return path.replace(OTHER_SEPARATOR, PATH_SEPARATOR)
         
 
+def sync_file(location):
+    """Flushes the contents of a file to disk"""
+
+    # opened for writing, since Windows can't flush a file opened only for reading
+    descriptor = os.open(location, os.O_RDWR)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def sync_file_system(location):
+    """Flushes the whole file system holding a location to disk with syncfs, returning
+    False where the system doesn't have it"""
+
+    try:
+        import ctypes
+        syncfs = ctypes.CDLL(None, use_errno = True).syncfs
+    except (ImportError, OSError, AttributeError, TypeError):
+        return False
+    descriptor = os.open(location, os.O_RDONLY)
+    try:
+        return syncfs(descriptor) == 0
+    finally:
+        os.close(descriptor)
+
+def discard_files(locations):
+    """Deletes the files that exist at the given locations"""
+
+    for location in locations:
+        if os.path.exists(location):
+            os.remove(location)
+
+def sync_directory(location):
+    """Flushes the entries of a directory to disk, where the system allows it"""
+
+    # directories can't be opened on Windows, where renames are flushed with the file
+    try:
+        descriptor = os.open(location, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+def copy_file_data(source_file, destination_file, size):
+    """Copies size bytes between open files, inside the kernel where the system allows it
+
+    copy_file_range lets the file system share or copy blocks on its own and
+    sendfile avoids copying through Python, otherwise the data is read and
+    written in chunks. Both files start at the beginning, and whatever a way
+    leaves uncopied is picked up by the next one.
+    """
+
+    source = source_file.fileno()
+    destination = destination_file.fileno()
+    copied = 0
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        source_file.seek(copied)
+        destination_file.seek(copied)
+        try:
+            while copied < size:
+                if name == "copy_file_range":
+                    count = os.copy_file_range(source, destination, size - copied)
+                else:
+                    count = os.sendfile(destination, source, copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError as error:
+            # try the next way if this one isn't supported for these files
+            if error.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP,
+                                   errno.EBADF):
+                raise
+        if copied == size:
+            return
+
+    import shutil
+    source_file.seek(copied)
+    destination_file.seek(copied)
+    shutil.copyfileobj(source_file, destination_file, HASH_CHUNK_SIZE)
+
+def hash_file(location):
+    """Returns the SHA-1 hex digest of the contents of a file"""
+
+    digest = hashlib.sha1()
+    file = open(location, 'rb')
+    chunk = file.read(HASH_CHUNK_SIZE)
+    while chunk:
+        digest.update(chunk)
+        chunk = file.read(HASH_CHUNK_SIZE)
+    file.close()
+    return digest.hexdigest()
+
 def save(lines):
     """Save the changes made to the settings file by rewriting its contents"""
     
@@ -608,47 +2918,434 @@ def save(lines):
 
 def create_writers(playlists, extension, export_location):
     """Creates and returns a list of writers corresponding to the extension and playlists"""
-
-    writers = []
-
-    # if the extension is WPL, make a WPL_Writer for all the playlists given
-    if extension.lower() == "wpl":
-        for playlist in playlists:
-            writers.append(WPL_Writer(playlist, export_location))
-
-    # if the extension is M3U8, make an M3U8_Writer for all the playlists given
-    if extension.lower() == "m3u8":
-        for playlist in playlists:
-            writers.append(M3U8_Writer(playlist, export_location))
-
-    return writers
+    return get_writers(playlists, [extension], export_location)
 
 def determine_writers(playlists, args, export_location):
     """Returns a list of writers corresponding to command line arguments or constants"""
 
+    if "wpl" in [extension.lower() for extension in args.extension]:
+        print("Length of playlists is " + str(len(playlists)))
+    return get_writers(playlists, args.extension, export_location, args.folder_tree)
+
+def get_writers(playlists, formats, export_location, folder_tree = False, media = None):
+    """Returns a list of writers of the playlists for every format given, writing locations
+    relative to the copies of the audio made by media, if given"""
+
     writers = []
 
-    # for every extension given, create a corresponding Playlist_Writer
-    for extension in args.extension:
-        
-        if extension.lower() == "wpl":
-            print("Length of playlists is " + str(len(playlists)))
-            for playlist in playlists:
-                writers.append(WPL_Writer(playlist, export_location))
+    # when exporting the folder tree, each playlist goes in the directory of its folder
+    roots = []
+    for playlist in playlists:
+        if folder_tree:
+            roots.append(os.path.join(export_location, *[get_file_name(name) for name
+                                                         in playlist.get_folder_names()]))
+        else:
+            roots.append(export_location)
 
-        if extension.lower() == "m3u8":
-            for playlist in playlists:
-                writers.append(M3U8_Writer(playlist, export_location))
+    # for every extension given, create the Playlist_Writer registered for it
+    for extension in formats:
+        writer_class = WRITERS.get(extension.lower())
+        if writer_class is None:
+            raise ValueError("unknown playlist format " + str(extension) + ", expected one of " +
+                             ", ".join(sorted(WRITERS)))
+        for playlist, root in zip(playlists, roots):
+            writers.append(writer_class(playlist, root))
 
+    for writer in writers:
+        writer.media = media
     return writers
 
-def check_for_excluded(list1, list2):
-    """Check to see if every item in list1 is in list2"""
-    
-    for item in list1:
-        if not item in list2:
-            sys.stderr.write("Item " + item + " not found!\n")
-
+def get_file_name(name):
+    """Returns the name of a playlist or folder made safe to use as a file or directory name"""
+
+    name = FILE_NAME_PATTERN.sub("_", name or "")
+
+    # an empty name, "." or ".." would name the directory itself or its parent
+    if not name.strip("."):
+        name = "_" + name
+    return name
+
+def escape_xml(text):
+    """Returns the text with the characters that would break an XML file escaped"""
+    return text.translate(XML_ESCAPES)
+
+def get_location_uri(location):
+    """Returns the file:// URL of an absolute location, or the relative URL of a relative one"""
+
+    path = location.replace("\\", "/")
+    if DRIVE_PATH_PATTERN.match(path):
+        return "file:///" + path[:2] + quote(path[2:])
+    elif path.startswith("//"):
+        return "file:" + quote(path)
+    elif path.startswith("/"):
+        return "file://" + quote(path)
+    return quote(path)
+
+def get_written_items(playlist):
+    """Returns the items of a playlist written to its files, leaving out the tracks without a
+    location, such as those only in the cloud"""
+    return [item for item in playlist.items if item.location is not None]
+
+def get_aggregates(items):
+    """Returns the total length and number of the items, shared by the headers of every writer"""
+
+    total = 0
+    for item in items:
+        total += item.length
+    return {'length' : total, 'count' : len(items)}
+
+def render_playlist(playlist, writers):
+    """Renders a playlist for every writer, returning the contents for each writer"""
+
+    items = get_written_items(playlist)
+    aggregates = get_aggregates(items)
+    return ["".join(writer.render_chunks(items, aggregates)) for writer in writers]
+
+def export_playlist(manifest, writers, previous_hashes, force = False):
+    """Streams a playlist through each of its writers and writes the files that changed
+
+    The items and aggregates of the playlist are looked up once and shared by
+    every writer, then each writer walks the list of items on its own. Feeding
+    every item to all the writers in a single walk was measured to be slower,
+    as the items are already resolved and switching writers for every item
+    costs more than walking the list again. Returns the number of seconds taken and, for each writer,
+    the hash of the contents, whether the file was written, the number of
+    bytes written and the error raised while writing it, if any.
+    """
+
+    start = time.perf_counter()
+    results = []
+    items = get_written_items(writers[0].playlist)
+    aggregates = get_aggregates(items)
+    for writer, previous_hash in zip(writers, previous_hashes):
+        try:
+            digest, written, size = manifest.write_chunks(
+                writer, writer.render_chunks(items, aggregates), previous_hash, force)
+        except (IOError, OSError) as error:
+            results.append((None, False, 0, error))
+        else:
+            results.append((digest, written, size, None))
+    return time.perf_counter() - start, results
+
+def export_writers(manifest, writers, jobs = 1, force = False, stats = None,
+                   on_conflict = "ask"):
+    """Writes the playlists of the writers on a pool of threads, recording them in the manifest
+
+    Locations are chosen one writer at a time in order, so names given to
+    colliding playlists do not depend on the number of jobs. The tracks of each
+    playlist are then resolved once for all of its writers and its files written
+    on the pool, and a playlist that fails is reported without stopping the others.
+    """
+
+    if stats is None:
+        stats = Null_Stats()
+
+    # choose every location up front, in order, against a single listing of each directory
+    with stats.phase("plan"):
+        claimed = set()
+        previous_hashes = []
+        for writer in writers:
+            previous_hashes.append(manifest.plan(writer, claimed, on_conflict))
+            claimed.add(writer.location)
+
+        # leave out the playlists skipped because their files exist
+        previous_hashes = [previous_hash for writer, previous_hash
+                           in zip(writers, previous_hashes) if not writer.skip]
+        writers = [writer for writer in writers if not writer.skip]
+
+        # create the directories of the folders being exported
+        for directory in set(os.path.dirname(writer.location) for writer in writers):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    # group the writers of each playlist, keeping the order playlists first appear in
+    groups = []
+    group_indexes = {}
+    for writer, previous_hash in zip(writers, previous_hashes):
+        if id(writer.playlist) not in group_indexes:
+            group_indexes[id(writer.playlist)] = len(groups)
+            groups.append(([], []))
+        group = groups[group_indexes[id(writer.playlist)]]
+        group[0].append(writer)
+        group[1].append(previous_hash)
+
+    # render and write the playlists in parallel
+    with stats.phase("write"):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers = jobs)
+        futures = [executor.submit(export_playlist, manifest, group[0], group[1], force)
+                   for group in groups]
+
+        # collect the results in order
+        for group, future in zip(groups, futures):
+            try:
+                seconds, results = future.result()
+            except Exception as error:
+                seconds, results = 0, [(None, False, 0, error)] * len(group[0])
+            stats.add_time(group[0][0].playlist, "write", seconds)
+            for writer, (digest, written, size, error) in zip(group[0], results):
+                stats.add_file(writer, written, size, error)
+                if error is not None:
+                    sys.stderr.write("Could not write " + writer.location + ": " +
+                                     str(error) + "\n")
+                    manifest.fail(writer)
+                else:
+                    manifest.record(writer, digest, written)
+        executor.shutdown()
+
+def parse_library_document(xml_file, backend = DEFAULT_BACKEND, cache_location = None,
+                           use_hash = False):
+    """Parses a library, in a worker process in batch mode, using the cache at cache_location
+    if given. Returns the document of the library and the number of seconds taken."""
+
+    start = time.perf_counter()
+    cache = None
+    document = None
+    if cache_location is not None:
+        cache = Library_Cache(cache_location, use_hash)
+        key = cache.get_key(xml_file, backend)
+        document = cache.load(key)
+    if document is None:
+        document = iTunes_Library.PARSERS[backend](xml_file).document
+        if cache is not None:
+            cache.save(key, document)
+    return document, time.perf_counter() - start
+
+def read_playlists(parser, nodes):
+    """Yields a Playlist for each playlist record read by a parser"""
+
+    for node in nodes:
+        playlist = Playlist(parser.get_playlist_parser(node))
+        playlist.set_quick()
+        yield playlist
+
+def iter_tracks(xml_file, rewriter = None):
+    """Yields the Track ID and Track of every track in a library
+
+    The library is read as it is iterated, keeping only the current track in
+    memory, and reading stops at the end of the tracks. Tracks without a
+    location, such as streams, have a location of None.
+    """
+
+    parser = iTunes_Library_Stream_Parser(xml_file, {})
+    if rewriter is not None:
+        parser.track_index.rewriter = rewriter
+    events = iterparse(xml_file, events = ("start", "end"))
+    for section, record in parser.iter_records(events, "Tracks"):
+        if section == "Tracks":
+            yield parser.get_track_id(record), parser.get_track_info(record)
+
+def iter_playlists(xml_file, rewriter = None):
+    """Yields a Playlist for every playlist in a library
+
+    Only the position of each track in the file is indexed up front. Playlists
+    are read one at a time as they are iterated and their tracks decoded when
+    their items are first read. The playlists are not linked to their folders,
+    use iTunes_Library for the folder hierarchy.
+    """
+
+    parser = iTunes_Library_Lazy_Parser(xml_file, {})
+    if rewriter is not None:
+        parser.track_index.rewriter = rewriter
+    parser.document["Track Offsets"] = parser.index_tracks()
+    nodes = (record for section, record in parser.iter_records(
+             parser.iter_events(parser.playlists_start)) if section == "Playlists")
+    for playlist in read_playlists(parser, nodes):
+        yield playlist
+
+def export(playlists, formats, export_location, folder_tree = False, jobs = DEFAULT_JOBS,
+           force = False, prune = False, keep = None, on_conflict = "rename",
+           sync = DEFAULT_SYNC, stats = None, media = None):
+    """Writes playlists in every format given to the export directory and returns its manifest
+
+    Playlist files unchanged since the last export are skipped. Files in the
+    way are handled by on_conflict, which is never "ask" unless asked for. When
+    pruning, the files of renamed playlists are deleted, along with those of
+    playlists whose Persistent IDs are not in keep, if it is given. When media
+    is given, the playlists point at the copies of their audio it made.
+    """
+
+    if stats is None:
+        stats = Null_Stats()
+
+    # the tracks are resolved here, since the worker threads writing them can't share the index
+    for playlist in playlists:
+        if playlist.rows is None:
+            playlist.set_items()
+
+    writers = get_writers(playlists, formats, export_location, folder_tree, media)
+    manifest = Export_Manifest(export_location, prune, sync, max(jobs, 1))
+    manifest.load()
+    if DEBUG:
+        print("Writing " + str(len(writers)) + " playlists")
+    try:
+        export_writers(manifest, writers, max(jobs, 1), force, stats, on_conflict)
+
+        # forget the files of playlists that are gone from the library
+        with stats.phase("manifest"):
+            if prune and keep is not None:
+                manifest.prune_playlists(set(keep))
+            manifest.save()
+    except BaseException:
+        manifest.discard()
+        raise
+    stats.count("files_deleted", manifest.deleted)
+    return manifest
+
+def get_library_report(library, top = DEFAULT_REPORT_TOP, use_numpy = True, stats = None):
+    """Returns the library wide reports on a library whose playlists have been read
+
+    The reports are the totals of the library, the length of every playlist
+    and the top artists, duplicate titles and overlapping pairs of playlists.
+    Each report is a list of dicts with the keys in REPORT_COLUMNS.
+    """
+
+    if stats is None:
+        stats = Null_Stats()
+    with stats.phase("columns"):
+        columns = Library_Columns(library, use_numpy)
+    playlists = columns.playlists
+
+    with stats.phase("report"):
+        counts, distinct, totals = columns.get_playlist_totals()
+        playlist_rows = [{'name' : playlist.name,
+                          'path' : "/".join(playlist.get_folder_names() + [playlist.name]),
+                          'id' : playlist.persistent_ID, 'items' : count, 'tracks' : tracks,
+                          'duplicate_items' : count - tracks, 'seconds' : total / 1000}
+                         for playlist, count, tracks, total in zip(playlists, counts, distinct,
+                                                                    totals)]
+
+        tracks, totals, items = columns.get_artist_totals()
+        order = sorted(range(len(tracks)), key = lambda code: (-tracks[code], -totals[code]))
+        artist_rows = [{'artist' : columns.artist_names[code], 'tracks' : tracks[code],
+                        'seconds' : totals[code] / 1000, 'playlist_items' : items[code]}
+                       for code in order[:top]]
+
+        duplicates = columns.get_duplicates()
+        duplicates.sort(key = lambda duplicate: (-len(duplicate[1]), -duplicate[2]))
+        duplicate_rows = []
+        for title, rows, holders in duplicates[:top]:
+            name, artist = columns.title_names[title]
+            duplicate_rows.append({'name' : name, 'artist' : artist, 'copies' : len(rows),
+                                   'track_ids' : " ".join(str(columns.ids[row]) for row in rows),
+                                   'playlists' : holders})
+
+        overlaps = columns.get_overlaps()
+        pairs = sorted(overlaps, key = lambda pair: (-overlaps[pair], pair))[:top]
+        overlap_rows = []
+        for first, second in pairs:
+            shared = overlaps[(first, second)]
+            union = distinct[first] + distinct[second] - shared
+            overlap_rows.append({'playlist' : playlists[first].name,
+                                 'other_playlist' : playlists[second].name,
+                                 'shared_tracks' : shared,
+                                 'similarity' : round(shared / union, 4) if union else 0})
+
+    summary = {'tracks' : len(columns.ids), 'playlists' : len(playlists),
+               'artists' : len(columns.artist_names),
+               'seconds' : sum(columns.milliseconds.tolist()) / 1000,
+               'duplicate_titles' : len(duplicates), 'missing_items' : columns.missing}
+    return {'summary' : [summary], 'playlists' : playlist_rows, 'artists' : artist_rows,
+            'duplicates' : duplicate_rows, 'overlap' : overlap_rows}
+
+def save_report(report, directory, report_format = "csv"):
+    """Saves each report in a CSV file of its name in the directory, or all of them in a
+    single report.json, returning the locations written"""
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if report_format == "json":
+        location = os.path.join(directory, "report.json")
+        report_file = codecs.open(location, 'w', "utf-8")
+        json.dump(report, report_file, indent = TAB_SIZE, ensure_ascii = False)
+        report_file.close()
+        return [location]
+
+    import csv
+    locations = []
+    for name, columns in REPORT_COLUMNS.items():
+        location = os.path.join(directory, name + ".csv")
+        report_file = open(location, 'w', encoding = "utf-8", newline = "")
+        writer = csv.DictWriter(report_file, columns)
+        writer.writeheader()
+        writer.writerows(report[name])
+        report_file.close()
+        locations.append(location)
+    return locations
+
+def verify_playlists(playlists, drop = False, jobs = DEFAULT_VERIFY_JOBS, stats = None,
+                     cache_location = None):
+    """Reports the tracks of resolved playlists whose files are missing, dropping them if asked,
+    keeping the files found in the cache at cache_location or the default one"""
+
+    if not playlists:
+        return
+    if stats is None:
+        stats = Null_Stats()
+
+    # check each location once, however many playlists it is in
+    tracks = playlists[0].parser.track_index.tracks
+    rows = set()
+    for playlist in playlists:
+        rows.update(playlist.rows)
+    if cache_location is None:
+        cache_location = get_file_cache_location()
+    verifier = File_Verifier(cache_location, jobs)
+    verifier.load()
+    missing = verifier.verify(tracks[row].location for row in rows
+                              if tracks[row].location is not None)
+    verifier.save()
+    print("Checked " + str(verifier.checked) + " of " + str(len(rows)) + " track files, " +
+          str(len(missing)) + " are missing.")
+    stats.count("files_checked", verifier.checked)
+    stats.count("files_missing", len(missing))
+    if not missing:
+        return
+
+    # report the missing tracks of each playlist
+    for playlist in playlists:
+        missing_rows = [row for row in playlist.rows if tracks[row].location in missing]
+        if not missing_rows:
+            continue
+        sys.stderr.write(playlist.name + " is missing " + str(len(missing_rows)) +
+                         " track files!\n")
+        for row in missing_rows:
+            sys.stderr.write(" " * TAB_SIZE + tracks[row].location + "\n")
+        if drop:
+            playlist.rows = array('l', [row for row in playlist.rows
+                                        if tracks[row].location not in missing])
+
+def sync_media(playlists, export_location, music_folder = None, mode = "copy",
+               media_dir = DEFAULT_MEDIA_DIR, jobs = DEFAULT_MEDIA_JOBS, stats = None):
+    """Copies or links the audio of resolved playlists into the export directory, returning
+    the Media_Sync that the writers use to point at the copies"""
+
+    if stats is None:
+        stats = Null_Stats()
+
+    # sync each audio file once, however many playlists it is in
+    media = Media_Sync(os.path.join(export_location, media_dir), music_folder, mode, jobs)
+    if playlists:
+        tracks = playlists[0].parser.track_index.tracks
+        rows = set()
+        for playlist in playlists:
+            rows.update(playlist.rows)
+        media.sync(tracks[row].location for row in rows)
+    print(str(media) + ".")
+    for name in sorted(media.counts):
+        stats.count("media_" + name, media.counts[name])
+    stats.count("media_bytes_copied", media.bytes_copied)
+    return media
+
+def get_playlist_signature(playlist):
+    """Returns a hash of everything written for a resolved playlist, used to tell if it changed"""
+
+    digest = hashlib.sha1()
+    digest.update(repr((playlist.name, playlist.get_folder_names())).encode("utf-8"))
+    for item in playlist.items:
+        digest.update(repr((item.location, item.length, item.name,
+                            item.artist)).encode("utf-8"))
+    return digest.digest()
 
 def command_line_args():
     """Set up command line arguments"""
@@ -661,36 +3358,179 @@ def command_line_args():
 
     # set up the available arguments
     parser.add_argument('-a', '--all', action = 'store_true', help = "export all playlists")
-    parser.add_argument('-e', '--extension', nargs = '*', default = [DEFAULT_FORMAT], help =
-                        "specify the extension of the playlist in the form 'wpl' or 'm3u8'")
+    parser.add_argument('--config', help = "read settings from this INI file instead of " +
+                        CONFIG_NAME + ".ini next to the settings file")
+    parser.add_argument('--headless', action = 'store_true', help = "never open dialogs or " +
+                        "ask questions, failing instead when something is missing")
+    parser.add_argument('--library', help = "specify the iTunes library xml file instead of " +
+                        "reading it from the settings file")
+    parser.add_argument('--export-dir', help = "specify the directory for the files to be " +
+                        "exported instead of reading it from the settings file")
+    parser.add_argument('--playlists-file', help = "specify the text file used by -f " +
+                        "instead of reading it from the settings file")
+    parser.add_argument('-e', '--extension', nargs = '*', default = [DEFAULT_FORMAT],
+                        type = str.lower, choices = sorted(WRITERS), help =
+                        "specify the extensions of the playlists to write, one of " +
+                        ", ".join(sorted(WRITERS)))
     parser.add_argument('-p', '--playlists', nargs = '*', help = "specify the playlists to export")
     parser.add_argument('-f', '--file', action = 'store_true',
                         help = "export playlists specified in a text file (use the settings" +
                         "file to specify the location of the text file)")
+    parser.add_argument('-b', '--backend', choices = sorted(iTunes_Library.PARSERS),
+                        default = DEFAULT_BACKEND, help = "specify the parser used to read " +
+                        "the library, 'stream' reads it in one pass, 'minidom' loads the " +
+                        "whole document, 'lazy' indexes the file and only decodes the " +
+                        "tracks being exported")
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = "parse the library even if it is unchanged since the last run")
+    parser.add_argument('--clear-cache', action = 'store_true',
+                        help = "delete the parsed library cache before reading the library")
+    parser.add_argument('--cache-hash', action = 'store_true',
+                        help = "also compare the contents of the library to the cached copy, " +
+                        "not only its size and modification time")
+    parser.add_argument('--force', action = 'store_true',
+                        help = "rewrite every playlist, even those unchanged since the last export")
+    parser.add_argument('--prune', action = 'store_true',
+                        help = "delete previously exported files of playlists that were " +
+                        "renamed or removed from the library")
+    parser.add_argument('-s', '--subtree', nargs = '*', default = [],
+                        help = "specify folders to export along with every playlist inside them")
+    parser.add_argument('--select', nargs = '*', default = [], metavar = 'PATTERN',
+                        help = "specify playlists to export by glob, 're:' regular " +
+                        "expression, 'id:' persistent ID or 'name:' exact name, 'tree:' " +
+                        "in front also exports everything inside matching folders")
+    parser.add_argument('--exclude', nargs = '*', default = [], metavar = 'PATTERN',
+                        help = "specify playlists and, with 'tree:', folders to leave out of " +
+                        "the export, in the same form as --select")
+    parser.add_argument('-t', '--folder-tree', action = 'store_true',
+                        help = "export playlists into directories matching their iTunes folders")
+    parser.add_argument('--on-conflict', choices = CONFLICT_POLICIES, help = "specify what " +
+                        "to do when a file not written by pyTunes Export is in the way of a " +
+                        "playlist, asking only when run from a terminal by default")
+    parser.add_argument('--sync', choices = SYNC_MODES, default = DEFAULT_SYNC,
+                        help = "specify how the files written are flushed to disk, all at " +
+                        "once at the end of the export (the default), one by one or not at all")
+    parser.add_argument('-j', '--jobs', type = int, default = DEFAULT_JOBS,
+                        help = "specify the number of playlists to write at the same time")
+    parser.add_argument('-r', '--rewrite', nargs = 2, action = 'append',
+                        metavar = ('FROM', 'TO'), help = "replace the start of track " +
+                        "locations, given as a path or file:// URL, with another path")
+    parser.add_argument('--media', choices = MEDIA_MODES, help = "copy or hard link the " +
+                        "audio of the exported playlists into the export directory and write " +
+                        "the playlists with paths relative to it")
+    parser.add_argument('--media-dir', default = DEFAULT_MEDIA_DIR, help = "specify the " +
+                        "directory in the export directory holding the audio")
+    parser.add_argument('--media-jobs', type = int, default = DEFAULT_MEDIA_JOBS,
+                        help = "specify the number of audio files copied at the same time")
+    parser.add_argument('--verify-files', action = 'store_true',
+                        help = "check that the file of every track exported exists")
+    parser.add_argument('--drop-missing', action = 'store_true', help = "leave the tracks " +
+                        "whose files are missing out of the playlists, implies --verify-files")
+    parser.add_argument('--verify-jobs', type = int, default = DEFAULT_VERIFY_JOBS,
+                        help = "specify the number of track files checked at the same time")
+    parser.add_argument('-w', '--watch', action = 'store_true', help = "keep running and " +
+                        "export the playlists that changed every time the library changes")
+    parser.add_argument('--watch-interval', type = float, default = WATCH_INTERVAL,
+                        help = "specify the number of seconds between checks of the library")
+    parser.add_argument('--batch', metavar = 'MANIFEST', help = "export the libraries of every " +
+                        "section of this INI file in one run, each section giving the library, " +
+                        "export_dir and other settings of a job")
+    parser.add_argument('--batch-parsers', type = int, help = "specify the number of processes " +
+                        "parsing libraries in batch mode, one per CPU by default")
+    parser.add_argument('--batch-writers', type = int, default = DEFAULT_BATCH_WRITERS,
+                        help = "specify the number of libraries whose playlists are written " +
+                        "at the same time in batch mode")
+    parser.add_argument('--report', metavar = 'DIRECTORY', help = "instead of exporting " +
+                        "playlists, save reports on the whole library to this directory: the " +
+                        "length of each playlist, the top artists, duplicate tracks and " +
+                        "playlists sharing tracks")
+    parser.add_argument('--report-format', choices = REPORT_FORMATS, default = "csv",
+                        help = "save the reports as a CSV file each or as one JSON file")
+    parser.add_argument('--report-top', type = int, default = DEFAULT_REPORT_TOP,
+                        help = "specify the number of rows of the artist, duplicate and " +
+                        "overlap reports")
+    parser.add_argument('--stats', action = 'store_true',
+                        help = "print the time taken by each phase of the export and its counters")
+    parser.add_argument('--stats-json', help = "save the timings and counters of the export " +
+                        "and of each playlist to this JSON file")
+    parser.add_argument('--profile', help = "save cProfile stats of the export to this file")
+    parser.add_argument('--trace-memory', help = "save a tracemalloc snapshot taken at the " +
+                        "end of the export to this file")
+
+    # the config file and environment give defaults that the command line overrides
+    parser.set_defaults(**get_config_defaults(parser))
 
     # parse and return the arguments
     args = parser.parse_args()
+    try:
+        Playlist_Selector(args.select, args.exclude)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.headless and args.batch is None and args.report is None and not (
+            args.all or args.playlists or args.file or args.subtree or args.select):
+        parser.error("playlists to export must be given in headless mode")
+    if args.headless and args.on_conflict == "ask":
+        parser.error("--on-conflict ask can't be used in headless mode")
+    if args.on_conflict is None:
+        args.on_conflict = ("ask" if sys.stdin.isatty() and not args.headless and
+                            args.batch is None else "rename")
+    if args.drop_missing:
+        args.verify_files = True
+    args.job_name = None
+    if args.report is not None and (args.watch or args.batch is not None):
+        parser.error("--report can't be used with --watch or --batch")
+    if args.batch is not None:
+        if args.watch:
+            parser.error("--watch can't be used with --batch")
+        args.batch_jobs = read_batch_manifest(parser, args)
     return args
 
 def settings_file(args):
     """Deal with settings file"""
     
+    # paths given as options, in the environment or in the config file come first
+    given = [args.library]
+    if args.report is None:
+        given.append(args.export_dir)
+    if args.file:
+        given.append(args.playlists_file)
+    if None not in given:
+        for path in given:
+            if not os.path.exists(path):
+                sys.stderr.write(path + " does not exist!\n")
+                sys.exit(1)
+        return args.library, args.export_dir, args.playlists_file if args.file else None
+
+    # headless runs never fall back to the settings file and its dialogs
+    if args.headless:
+        sys.stderr.write("The library, export directory (unless reporting) and playlists " +
+                         "file (with -f) must be given in headless mode!\n")
+        sys.exit(1)
+
     if DEBUG:
         print("Reading the settings file")
 
     lines = get_settings_lines()
+    while len(lines) < 3:
+        lines.append("\n")
     
     # test to see if the paths in the file exist, prompt for new ones if they don't
     try:
-        library_location = confirm_name(lines, 1, [('xml files', '.xml')],
-                                        "Choose iTunes library xml file")
-        export_location = confirm_name(lines, 2, None,
-                                       "Choose the directory for the files to be exported")
+        library_location = args.library
+        if library_location is None:
+            library_location = confirm_name(lines, 1, [('xml files', '.xml')],
+                                            "Choose iTunes library xml file")
+        export_location = args.export_dir
+        if export_location is None and args.report is None:
+            export_location = confirm_name(lines, 2, None,
+                                           "Choose the directory for the files to be exported")
         playlists_location = None
         if args.file:
-            playlists_location = confirm_name(lines, 3, [('Text files', '.txt')],
-                                              "Choose the location of the text file " +
-                                              "containing the playlists")
+            playlists_location = args.playlists_file
+            if playlists_location is None:
+                playlists_location = confirm_name(lines, 3, [('Text files', '.txt')],
+                                                  "Choose the location of the text file " +
+                                                  "containing the playlists")
     
     # if a user does not choose a directory, catch the SystemExit exception, save and exit
     except SystemExit:
@@ -704,6 +3544,56 @@ def settings_file(args):
 def write_playlists(args, library_location, export_location, playlists_location):
     """Create the iTunes Library object and write the playlists"""
 
+    playlist_names = read_playlist_names(args, playlists_location)
+    if args.headless and args.report is None and not (playlist_names or args.all or
+                                                      args.subtree or args.select):
+        sys.stderr.write("The playlists file " + str(playlists_location) + " gives no " +
+                         "playlists to export in headless mode!\n")
+        sys.exit(1)
+
+    # only collect stats if they were asked for
+    stats = Null_Stats()
+    if args.stats or args.stats_json is not None:
+        stats = Export_Stats()
+    if args.trace_memory is not None:
+        import tracemalloc
+        tracemalloc.start()
+
+    # set up the parsed library cache
+    cache = None
+    if args.clear_cache:
+        Library_Cache(get_cache_location()).clear()
+    if not args.no_cache:
+        cache = Library_Cache(get_cache_location(), args.cache_hash)
+
+    stats.add_phase("startup", time.perf_counter() - START_TIME)
+
+    # take the state of the library before reading it, so a save during the export isn't missed
+    watcher = None
+    if args.watch:
+        watcher = Library_Watcher(library_location, args.watch_interval)
+    signatures = None
+    if args.report is not None:
+        report_library(args, library_location, cache, stats)
+    else:
+        signatures = export_library(args, library_location, export_location, playlist_names,
+                                    cache, stats)
+
+    # report the stats and the memory traced
+    if args.trace_memory is not None:
+        stats.count("peak_traced_bytes", tracemalloc.get_traced_memory()[1])
+        tracemalloc.take_snapshot().dump(args.trace_memory)
+        tracemalloc.stop()
+    report_stats(args, stats)
+
+    if args.watch:
+        watch_library(args, library_location, export_location, playlist_names, cache,
+                      signatures, watcher)
+
+def read_playlist_names(args, playlists_location):
+    """Returns the names of the playlists given on the command line or, if the location of
+    a playlists file is given, in the file"""
+
     playlist_names = args.playlists
     if playlist_names is None:
         playlist_names = []
@@ -724,22 +3614,213 @@ def write_playlists(args, library_location, export_location, playlists_location)
         # close the file
         playlists_file.close()
 
+    return playlist_names
+
+def export_library(args, library_location, export_location, playlist_names, cache, stats,
+                   signatures = None, document = None):
+    """Reads the library and writes the playlists to export
+
+    The document of the library is used instead of reading it if given. In
+    watch mode, returns the signature of each playlist exported and only
+    writes the playlists whose signature differs from the given ones.
+    """
 
     # create the library and get the items to export
     if DEBUG:
         print("Reading library")
-    library = iTunes_Library(library_location)
-    library.get_items(playlist_names, args.all)
-    playlist_names = ', '.join([playlist.name for playlist in library.export]) 
+    with stats.phase("parse"):
+        library = iTunes_Library(library_location, args.backend, cache,
+                                 Location_Rewriter(args.rewrite or ()), document)
+    with stats.phase("playlists"):
+        library.get_playlists()
+    with stats.phase("select"):
+        library.export = library.get_selection(playlist_names, args.all, args.subtree,
+                                               args.select, args.exclude,
+                                               not args.headless and args.job_name is None)
+    with stats.phase("resolve"):
+        for playlist in library.export:
+            playlist.set_items()
+            stats.add_playlist(playlist)
+    if args.verify_files:
+        with stats.phase("verify"):
+            verify_playlists(library.export, args.drop_missing, args.verify_jobs, stats,
+                             get_file_cache_location(args.job_name))
+
+    # keep only the playlists that changed since the last round
+    new_signatures = None
+    to_export = library.export
+    if args.watch:
+        with stats.phase("compare"):
+            new_signatures = {}
+            to_export = []
+            for playlist in library.export:
+                signature = get_playlist_signature(playlist)
+                new_signatures[playlist.persistent_ID] = signature
+                if signatures is None or signatures.get(playlist.persistent_ID) != signature:
+                    to_export.append(playlist)
+    playlist_names = ', '.join([playlist.name for playlist in to_export]) 
     print("Items to export are " + str(playlist_names) + ".")
 
-    # create writers for the items and write them to disk
-    writers = determine_writers(library.export, args, export_location)
-    if DEBUG:
-        print("Writing " + str(len(writers)) + " playlists")
-    for writer in writers:
-        writer.change_location()
-        writer.write_file()
+    # put the audio of the playlists next to them
+    media = None
+    if args.media is not None:
+        with stats.phase("media"):
+            media = sync_media(to_export, export_location, library.get_music_folder(),
+                               args.media, args.media_dir, args.media_jobs, stats)
+
+    # write the changed playlists to disk
+    if "wpl" in [extension.lower() for extension in args.extension]:
+        print("Length of playlists is " + str(len(to_export)))
+    manifest = export(to_export, args.extension, export_location,
+                      folder_tree = args.folder_tree, jobs = args.jobs, force = args.force,
+                      prune = args.prune,
+                      keep = [playlist.persistent_ID for playlist in library.playlists],
+                      on_conflict = args.on_conflict, sync = args.sync, stats = stats,
+                      media = media)
+    print(str(manifest) + ".")
+
+    # forget the playlists that failed, so the next round writes them again
+    if new_signatures is not None:
+        for playlist_ID in manifest.failed_IDs:
+            new_signatures.pop(playlist_ID, None)
+    return new_signatures
+
+def report_library(args, library_location, cache, stats):
+    """Reads the library and saves the library wide reports asked for on the command line"""
+
+    with stats.phase("parse"):
+        library = iTunes_Library(library_location, args.backend, cache,
+                                 Location_Rewriter(args.rewrite or ()))
+    with stats.phase("playlists"):
+        library.get_playlists()
+    report = get_library_report(library, args.report_top, stats = stats)
+    with stats.phase("save"):
+        locations = save_report(report, args.report, args.report_format)
+
+    summary = report['summary'][0]
+    print("Library has " + str(summary['tracks']) + " tracks by " + str(summary['artists']) +
+          " artists in " + str(summary['playlists']) + " playlists, " +
+          str(summary['duplicate_titles']) + " titles have duplicates.")
+    print("Saved " + ", ".join(locations) + ".")
+
+def export_batch(args):
+    """Exports the libraries of every job of the batch manifest in one process
+
+    Libraries are parsed on a pool of processes and, as each one is parsed,
+    its playlists are selected and written on a pool of threads. A job that
+    fails is reported and the others carry on. Returns the jobs that failed.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+    start = time.perf_counter()
+    jobs = args.batch_jobs
+    print("Exporting " + str(len(jobs)) + " libraries in batch mode.")
+    parsers = ProcessPoolExecutor(max_workers = args.batch_parsers)
+    writers = ThreadPoolExecutor(max_workers = args.batch_writers)
+    try:
+        # parse every library, each with a cache of its own
+        parses = {}
+        for job in jobs:
+            cache_location = None
+            if args.clear_cache:
+                Library_Cache(get_cache_location(job.name)).clear()
+            if not job.args.no_cache:
+                cache_location = get_cache_location(job.name)
+            parses[parsers.submit(parse_library_document, job.args.library, job.args.backend,
+                                  cache_location, job.args.cache_hash)] = job
+
+        # write the playlists of each library as soon as it has been parsed
+        exports = []
+        for future in as_completed(parses):
+            job = parses[future]
+            try:
+                document, seconds = future.result()
+            except Exception as error:
+                job.fail(error)
+                continue
+            exports.append(writers.submit(job.run, document, seconds))
+        for future in exports:
+            future.result()
+    finally:
+        parsers.shutdown()
+        writers.shutdown()
+
+    report_batch(args, jobs, time.perf_counter() - start)
+    return [job for job in jobs if job.error is not None]
+
+def report_batch(args, jobs, seconds):
+    """Prints the outcome and throughput of each job and of the whole batch"""
+
+    for job in jobs:
+        print(job.get_summary())
+        if args.stats:
+            job.stats.print_table()
+
+    items = sum(job.stats.counters.get("items", 0) for job in jobs)
+    failed = sum(1 for job in jobs if job.error is not None)
+    summary = ("Batch: " + str(len(jobs) - failed) + " of " + str(len(jobs)) +
+               " jobs succeeded, " + str(items) + " items in " + "%.3f" % seconds + " s")
+    if seconds > 0:
+        summary += " (" + "%.0f" % (items / seconds) + " items/s)"
+    print(summary + ".")
+
+    if args.stats_json is not None:
+        stats_file = codecs.open(args.stats_json, 'w', "utf-8")
+        json.dump({'seconds' : seconds, 'jobs' : [job.get_record() for job in jobs]},
+                  stats_file, indent = TAB_SIZE)
+        stats_file.close()
+
+def report_stats(args, stats):
+    """Prints or saves the stats of an export as asked for on the command line"""
+
+    if args.stats:
+        stats.print_table()
+    if args.stats_json is not None:
+        stats.save(args.stats_json)
+
+def watch_library(args, library_location, export_location, playlist_names, cache, signatures,
+                  watcher):
+    """Exports the playlists again every time the library changes, until interrupted
+
+    The signatures of the playlists are kept between rounds so only the
+    playlists whose contents changed are rendered and written. The watcher
+    holds the state of the library from before the first export.
+    """
+
+    print("Watching " + library_location + " for changes, press Ctrl+C to stop.")
+    rounds = 0
+    try:
+        while True:
+            watcher.wait_for_change()
+            rounds += 1
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(now + " Round " + str(rounds) + ": library changed, exporting.")
+
+            stats = Null_Stats()
+            if args.stats or args.stats_json is not None:
+                stats = Export_Stats()
+            start = time.perf_counter()
+
+            # keep watching if the library can't be read, it may be rewritten again
+            try:
+                new_signatures = export_library(args, library_location, export_location,
+                                                playlist_names, cache, stats, signatures)
+            except Exception as error:
+                sys.stderr.write(now + " Round " + str(rounds) + " failed: " +
+                                 type(error).__name__ + ": " + str(error) + "!\n")
+                continue
+
+            changed = sum(1 for playlist_ID, signature in new_signatures.items()
+                          if signatures.get(playlist_ID) != signature)
+            signatures = new_signatures
+            print(datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " Round " + str(rounds) +
+                  ": " + str(changed) + " of " + str(len(signatures)) +
+                  " playlists changed, took " + "%.3f" % (time.perf_counter() - start) +
+                  " s.")
+            report_stats(args, stats)
+    except KeyboardInterrupt:
+        print("Stopped watching after " + str(rounds) + " rounds.")
 
 ##################################################################
 ## BODY
@@ -747,6 +3828,17 @@ def write_playlists(args, library_location, export_location, playlists_location)
 
 if __name__ == "__main__":
     args = command_line_args()
-    library_location, export_location, playlists_location = settings_file(args)
-    write_playlists(args, library_location, export_location, playlists_location)
+    if args.batch is not None:
+        run, run_args = export_batch, (args,)
+    else:
+        run, run_args = write_playlists, (args,) + settings_file(args)
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        failed = profiler.runcall(run, *run_args)
+        profiler.dump_stats(args.profile)
+    else:
+        failed = run(*run_args)
     print("Finished writing playlists, will now exit!")
+    if failed:
+        sys.exit(1)